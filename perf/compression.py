@@ -0,0 +1,72 @@
+import socket
+import threading
+import time
+
+import numpy as np
+import portal
+
+
+def main():
+    bandwidth = 100 * 1024**2  # Bytes per second in each direction.
+    calls = 20
+
+    def server(port):
+        server = portal.Server(port)
+        server.bind('foo', lambda x: b'ok')
+        server.start(block=True)
+
+    def forward(src, dst):
+        # Throttle to the bandwidth limit, similar to a cross-node link.
+        start, total = time.perf_counter(), 0
+        while data := src.recv(1024**2):
+            dst.sendall(data)
+            total += len(data)
+            delay = start + total / bandwidth - time.perf_counter()
+            delay > 0 and time.sleep(delay)
+        dst.close()
+
+    def proxy(port1, port2):
+        listener = socket.create_server(('localhost', port2))
+        while True:
+            conn, _ = listener.accept()
+            upstream = socket.create_connection(('localhost', port1))
+            for src, dst in ((conn, upstream), (upstream, conn)):
+                threading.Thread(target=forward, args=(src, dst)).start()
+
+    def client(port2):
+        rng = np.random.default_rng(0)
+        frames = np.zeros((64, 64, 64, 3), np.uint8)
+        frames[:, 16:48, 16:48] = rng.integers(0, 255, (64, 32, 32, 3))
+        data = {
+            'frames': frames,
+            'masks': (rng.random((64, 4096)) < 0.1).astype(np.int8),
+            'rewards': rng.random(64, np.float32),
+        }
+        size = sum(x.nbytes for x in data.values())
+        for codec in (None, 'zlib', 'lzma'):
+            client = portal.Client(port2, codec=codec)
+            client.foo(data).result()
+            start = time.perf_counter()
+            for _ in range(calls):
+                assert client.foo(data).result() == b'ok'
+            dur = time.perf_counter() - start
+            wire = sum(len(x) for x in portal.pack(data, codec))
+            print(
+                f'{str(codec):>4}: {calls * size / dur / 1024**2:.0f} MB/s '
+                f'effective, {100 * wire / size:.0f}% on the wire'
+            )
+            client.close()
+
+    portal.setup(host='localhost')
+    port1 = portal.free_port()
+    port2 = portal.free_port()
+    workers = [
+        portal.Process(server, port1),
+        portal.Process(proxy, port1, port2),
+        portal.Process(client, port2),
+    ]
+    portal.run(workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import selectors
+import socket
+import time
+
+import portal
+
+
+def main():
+    counts = [100, 500, 2000]
+    logging = True
+
+    def server(port):
+        server = portal.ServerSocket(port, logging=logging)
+        while True:
+            addr, data = server.recv()
+            server.send(addr, data)
+
+    def client(port):
+        # Plain sockets that all connect at once, like actors reconnecting
+        # after the learner restarted, and each send a first request.
+        request = b'portal_handshake' + (4).to_bytes(8, 'little') + b'ping'
+        reply = (4).to_bytes(8, 'little') + b'ping'
+        for count in counts:
+            sel = selectors.DefaultSelector()
+            start = time.perf_counter()
+            for _ in range(count):
+                sock = socket.socket()
+                sock.setblocking(False)
+                sock.connect_ex(('localhost', port))
+                sel.register(sock, selectors.EVENT_WRITE, [b''])
+            remaining = count
+            while remaining:
+                for key, mask in sel.select():
+                    sock, received = key.fileobj, key.data
+                    if mask & selectors.EVENT_WRITE:
+                        sock.sendall(request)
+                        sel.modify(sock, selectors.EVENT_READ, received)
+                        continue
+                    received[0] += sock.recv(len(reply))
+                    if received[0] == reply:
+                        sel.unregister(sock)
+                        sock.close()
+                        remaining -= 1
+            duration = time.perf_counter() - start
+            print(
+                f'{count} clients: {1000 * duration:.0f}ms until all first '
+                f'calls returned ({count / duration:.0f} conn/s)'
+            )
+            sel.close()
+            time.sleep(1)
+
+    portal.setup(host='localhost')
+    port = portal.free_port()
+    workers = [
+        portal.Process(server, port),
+        portal.Process(client, port),
+    ]
+    portal.run(workers)
+
+
+if __name__ == '__main__':
+    main()
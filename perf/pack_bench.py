@@ -0,0 +1,63 @@
+import functools
+import timeit
+
+import numpy as np
+import portal
+
+
+def main():
+    duration = 1.0  # Seconds per measurement.
+
+    def nested(depth, width, leaf):
+        if not depth:
+            return leaf()
+        return {f'k{i}': nested(depth - 1, width, leaf) for i in range(width)}
+
+    def small():
+        return np.zeros(8, np.float32)
+
+    trees = {
+        'shallow, many small': {f'k{i}': small() for i in range(500)},
+        'shallow, few large': {
+            f'k{i}': np.zeros(2**22, np.uint8) for i in range(4)
+        },
+        'deep, many small': nested(4, 5, small),
+        'chain, one leaf': [[[[[[[[[[[[[[[[small()]]]]]]]]]]]]]]]],
+        'mixed': {
+            'obs': {'image': np.zeros((64, 64, 3), np.uint8), 'vec': small()},
+            'actions': [small() for _ in range(32)],
+            'info': ('text', None, 3, b'bytes'),
+        },
+    }
+
+    def measure(fn):
+        count, start = 0, timeit.default_timer()
+        while timeit.default_timer() - start < duration:
+            fn()
+            count += 1
+        return 1e6 * (timeit.default_timer() - start) / count
+
+    print(
+        f'{"tree":<22} {"leaves":>6} {"flatten":>10} {"unflatten":>10} '
+        f'{"pack":>10} {"unpack":>10}'
+    )
+    for name, tree in trees.items():
+        leaves, structure = portal.packlib.tree_flatten(tree)
+        # Received messages are memoryviews, which slice without copying.
+        buffer = memoryview(b''.join(portal.pack(tree)))
+        times = [
+            measure(functools.partial(portal.packlib.tree_flatten, tree)),
+            measure(
+                functools.partial(
+                    portal.packlib.tree_unflatten, leaves, structure
+                )
+            ),
+            measure(functools.partial(portal.pack, tree)),
+            measure(functools.partial(portal.unpack, buffer)),
+        ]
+        times = ' '.join(f'{x:>8.1f}us' for x in times)
+        print(f'{name:<22} {len(leaves):>6} {times}')
+
+
+if __name__ == '__main__':
+    main()
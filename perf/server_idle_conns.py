@@ -0,0 +1,70 @@
+import socket
+import time
+
+import portal
+
+
+def main():
+    size = 1024
+    prefetch = 16
+    duration = 3
+    counts = [0, 10, 100, 1000]
+
+    def server(port):
+        server = portal.ServerSocket(port, logging=False)
+        while True:
+            addr, data = server.recv()
+            if data == b'exit':
+                break
+            server.send(addr, b'ok')
+            assert len(data) == size
+        server.close()
+
+    def idler(port, counts, ready, proceed):
+        # Plain sockets that complete the handshake and then stay silent, so
+        # that the client process does not pay for their loop threads.
+        socks = []
+        for count in counts:
+            while len(socks) < count:
+                sock = socket.create_connection(('localhost', port))
+                sock.sendall(b'portal_handshake')
+                socks.append(sock)
+            ready.release()
+            proceed.acquire()
+        [x.close() for x in socks]
+
+    def client(port, counts, ready, proceed):
+        data = bytearray(size)
+        client = portal.ClientSocket(port, logging=False)
+        for count in counts:
+            ready.acquire()
+            for _ in range(prefetch):
+                client.send(data)
+            numrecv = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                client.send(data)
+                assert client.recv() == b'ok'
+                numrecv += 1
+            for _ in range(prefetch):
+                client.recv()
+            rate = numrecv / (time.perf_counter() - start)
+            print(f'{count} idle connections: {rate:.0f} msg/s')
+            proceed.release()
+        client.send(b'exit')
+        client.close()
+
+    portal.setup(host='localhost')
+    port = portal.free_port()
+    ready = portal.context.mp.Semaphore(0)
+    proceed = portal.context.mp.Semaphore(0)
+    workers = [
+        portal.Process(server, port),
+        portal.Process(idler, port, counts, ready, proceed),
+        portal.Process(client, port, counts, ready, proceed),
+    ]
+    portal.run(workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,11 @@ def main():
     size = 1024**3 // 4
     prefetch = 8
     twoway = False
+    profile = 'auto'  # 'latency', 'throughput', 'auto'
+    connections = 1  # Stripe requests over this many TCP connections.
 
     def server(port):
-        server = portal.Server(port)
+        server = portal.Server(port, profile=profile)
 
         # server = portal.BatchServer(port)
         # server = portal.BatchServer(port, process=False)
@@ -24,7 +26,12 @@ def main():
 
     def client(port):
         data = bytearray(size)
-        client = portal.Client(port, maxinflight=prefetch + 1)
+        client = portal.Client(
+            port,
+            maxinflight=prefetch + 1,
+            profile=profile,
+            connections=connections,
+        )
         futures = collections.deque()
         for _ in range(prefetch):
             futures.append(client.call('foo', data))
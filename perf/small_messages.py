@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+import portal
+
+
+def main():
+    duration = 3
+
+    def server(port):
+        server = portal.Server(port)
+        server.bind('foo', lambda *args: None)
+        server.start(block=True)
+
+    def client(port):
+        # Arguments of a typical control message, made of scalars, short
+        # strings, and flags rather than large arrays.
+        data = [
+            *range(8),
+            *[0.5 * x for x in range(6)],
+            'actor-17',
+            'train',
+            None,
+            b'\x01\x02',
+            np.zeros(4, np.float32),
+            np.int32(3),
+        ]
+        # Message length, request number, method name length and name.
+        iovecs = 4 + len(portal.pack(data))
+        client = portal.Client(port)
+        client.foo(*data).result()
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < duration:
+            client.foo(*data).result()
+            count += 1
+        latency = 1e6 * (time.perf_counter() - start) / count
+        size = sum(len(x) for x in portal.pack(data))
+        # Serialization alone, without the scheduling noise of a round trip.
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < duration:
+            portal.unpack(memoryview(b''.join(portal.pack(data))))
+            count += 1
+        codec = 1e6 * (time.perf_counter() - start) / count
+        print(
+            f'{len(data)} leaves: {latency:.0f}us per call, '
+            f'{codec:.0f}us pack and unpack, '
+            f'{iovecs} iovecs and {size} bytes per request'
+        )
+
+    portal.setup(host='localhost')
+    port = portal.free_port()
+    workers = [
+        portal.Process(server, port),
+        portal.Process(client, port),
+    ]
+    portal.run(workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import collections
 import time
 
 import portal
+import psutil
 
 
 def main():
@@ -18,15 +19,31 @@ def main():
     def client(port):
         data = [bytearray(size // parts) for _ in range(parts)]
         client = portal.ClientSocket(port)
+        # Count read and write syscalls of the client process, which include
+        # the wakeup signals of the socket loop. Sampled every few calls
+        # because reading the counters is a syscall itself.
+        proc = psutil.Process()
+        signal = client.reactor.signal
         durations = collections.deque(maxlen=10)
+        every = 1000
         while True:
-            start = time.perf_counter()
-            client.send(*data)
-            client.recv()
-            end = time.perf_counter()
-            durations.append(end - start)
+            io = proc.io_counters()
+            wakeups = signal.numwrites + signal.numreads
+            for _ in range(every):
+                start = time.perf_counter()
+                client.send(*data)
+                client.recv()
+                end = time.perf_counter()
+                durations.append(end - start)
             ping = sum(durations) / len(durations)
-            print(1000 * ping)  # <1ms
+            io2 = proc.io_counters()
+            reads = (io2.read_count - io.read_count) / every
+            writes = (io2.write_count - io.write_count) / every
+            wakeups = (signal.numwrites + signal.numreads - wakeups) / every
+            print(
+                f'{1000 * ping:.3f}ms latency, {reads:.2f} reads, '
+                + f'{writes:.2f} writes, {wakeups:.2f} wakeups per call'
+            )  # <1ms
 
     portal.setup(host='localhost')
     port = portal.free_port()
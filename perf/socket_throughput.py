@@ -9,10 +9,12 @@ def main():
     parts = 64
     prefetch = 8
     twoway = False
+    shm_ring = 0  # Use shared memory pipes of this size instead of TCP.
+    zerocopy = 0  # Send writes of at least this size with MSG_ZEROCOPY.
     assert size % parts == 0
 
     def server(port):
-        server = portal.ServerSocket(port)
+        server = portal.ServerSocket(port, zerocopy=zerocopy)
         while True:
             addr, data = server.recv()
             if twoway:
@@ -23,11 +25,15 @@ def main():
 
     def client(port):
         data = [bytearray(size // parts) for _ in range(parts)]
-        client = portal.ClientSocket(port)
+        client = portal.ClientSocket(
+            port, shm_ring=shm_ring, zerocopy=zerocopy
+        )
         for _ in range(prefetch):
             client.send(*data)
         durations = collections.deque(maxlen=50)
+        cputimes = collections.deque(maxlen=50)
         start = time.time()
+        cpustart = time.process_time()
         while True:
             client.send(*data)
             result = client.recv()
@@ -36,12 +42,16 @@ def main():
             else:
                 assert result == b'ok'
             end = time.time()
+            cpuend = time.process_time()
             durations.append(end - start)
-            start = end
+            cputimes.append(cpuend - cpustart)
+            start, cpustart = end, cpuend
             avgdur = sum(durations) / len(durations)
             mbps = size / avgdur / (1024**2)
             mbps *= 2 if twoway else 1
-            print(mbps)  # 3500 oneway, 2500 twoway
+            # Client CPU seconds per GiB sent.
+            cpu = sum(cputimes) / len(cputimes) / (size / 1024**3)
+            print(f'{mbps:.0f} MB/s, {cpu:.2f} CPU s/GiB')  # 3500 oneway
 
     portal.setup(host='localhost')
     port = portal.free_port()
@@ -19,6 +19,7 @@ from .client_socket import ClientSocket
 from .client_socket import Disconnected
 
 from .client import Client
+from .async_client import AsyncClient
 from .server import Server
 from .batching import BatchServer
 
@@ -32,4 +33,5 @@ from .utils import free_port
 from .utils import proc_alive
 from .utils import run
 
+from . import codecs
 from . import futures
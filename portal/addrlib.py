@@ -0,0 +1,89 @@
+import ipaddress
+import os
+import socket
+import stat
+
+import psutil
+
+from . import contextlib
+
+
+UNIX = 'unix://'
+
+
+def is_unix(addr):
+    return isinstance(addr, str) and addr.startswith(UNIX)
+
+
+def unix_path(addr):
+    assert is_unix(addr), addr
+    return addr[len(UNIX) :]
+
+
+def parse(addr, ipv6=False):
+    # Returns either a Unix socket address or a tuple of host and port.
+    addr = str(addr)
+    if is_unix(addr):
+        return addr
+    assert '://' not in addr, addr
+    host, port = addr.rsplit(':', 1) if ':' in addr else ('', addr)
+    host = host or ('::1' if ipv6 else '127.0.0.1')
+    return (host, port)
+
+
+def resolve(addr, ipv6=False):
+    # Returns the socket family and address to connect to. We need to resolve
+    # the address regularly, because the resolver may change its result.
+    if is_unix(addr):
+        return socket.AF_UNIX, unix_path(addr)
+    host, port = addr
+    if contextlib.context.resolver:
+        host, port = contextlib.context.resolver((host, port))
+        assert isinstance(host, str), (host, port)
+    port = int(port)
+    if ipv6:
+        return socket.AF_INET6, (host, port, 0, 0)
+    return socket.AF_INET, (host, port)
+
+
+def describe(addr):
+    if isinstance(addr, (tuple, list)):
+        return f'{addr[0]}:{addr[1]}'
+    return str(addr)
+
+
+def listen_unix(path):
+    # Remove the socket file left behind by a previous server that did not
+    # shut down cleanly, because binding would fail otherwise.
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    return sock
+
+
+def is_local(host):
+    # Whether the host resolves to a loopback address or an address of one of
+    # the network interfaces of this machine.
+    try:
+        ips = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    local = {
+        addr.address.split('%')[0]
+        for addrs in psutil.net_if_addrs().values()
+        for addr in addrs
+    }
+    for ip in ips:
+        ip = ip.split('%')[0]
+        try:
+            if ipaddress.ip_address(ip).is_loopback:
+                return True
+        except ValueError:
+            continue
+        if ip in local:
+            return True
+    return False
@@ -0,0 +1,246 @@
+import asyncio
+import functools
+import itertools
+import socket
+
+from . import addrlib
+from . import buffers
+from . import client_socket
+from . import codecs
+from . import contextlib
+from . import packlib
+
+
+class AsyncClient:
+    def __init__(
+        self,
+        addr,
+        name='Client',
+        maxinflight=16,
+        codec=None,
+        codec_minsize=64 * 1024,
+        **kwargs,
+    ):
+        assert 1 <= maxinflight, maxinflight
+        assert not codec or codecs.available(codec), codec
+        self.name = name
+        self.maxinflight = maxinflight
+        self.codec = codec
+        self.codec_minsize = codec_minsize
+        self.codecfailed = False
+        self.options = client_socket.Options(
+            **{**contextlib.context.clientkw, **kwargs}
+        )
+        self.addr = addrlib.parse(addr, self.options.ipv6)
+        self.reqnum = iter(itertools.count(0))
+        self.futures = {}  # {reqnum: asyncio.Future}
+        self.protocol = None
+        self.connecting = None
+        self.slots = None
+        self.closed = False
+
+    @property
+    def connected(self):
+        return bool(self.protocol and self.protocol.alive)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    async def connect(self, timeout=None):
+        await asyncio.wait_for(self._ensure(), timeout)
+
+    async def call(self, method, *data):
+        assert not self.closed
+        if not self.connected:
+            if not self.options.autoconn:
+                raise client_socket.Disconnected
+            await self._ensure()
+        # The semaphore is created here because it needs a running loop on
+        # older Python versions.
+        self.slots = self.slots or asyncio.Semaphore(self.maxinflight)
+        async with self.slots:
+            reqnum = next(self.reqnum).to_bytes(8, 'little', signed=False)
+            name = method.encode('utf-8')
+            strlen = len(name).to_bytes(8, 'little', signed=False)
+            codec = self.protocol.codec if self.protocol else None
+            packed = packlib.pack(data, codec, self.codec_minsize)
+            future = asyncio.get_running_loop().create_future()
+            future.sendargs = (reqnum, strlen, name, *packed)
+            self.futures[reqnum] = future
+            try:
+                await self._send(future.sendargs)
+                return await future
+            finally:
+                self.futures.pop(reqnum, None)
+
+    async def close(self):
+        self.closed = True
+        if self.connecting:
+            self.connecting.cancel()
+        if self.protocol:
+            self.protocol.transport.close()
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(client_socket.Disconnected())
+        self.futures.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *e):
+        await self.close()
+
+    async def _ensure(self):
+        if self.connected:
+            return
+        if not self.connecting or self.connecting.done():
+            self.connecting = asyncio.ensure_future(self._connect())
+        await asyncio.shield(self.connecting)
+
+    async def _connect(self):
+        self._log(f'Connecting to {addrlib.describe(self.addr)}')
+        loop = asyncio.get_running_loop()
+        once = True
+        while not self.closed:
+            family, addr = addrlib.resolve(self.addr, self.options.ipv6)
+            factory = functools.partial(Protocol, self)
+            try:
+                if family == socket.AF_UNIX:
+                    _, protocol = await loop.create_unix_connection(
+                        factory, addr
+                    )
+                else:
+                    _, protocol = await loop.create_connection(
+                        factory, addr[0], addr[1], family=family
+                    )
+                await protocol.ready
+                self.protocol = protocol
+                self._log('Connection established')
+                return
+            except (OSError, socket.gaierror) as e:
+                if once:
+                    self._log(f'Still trying to connect... ({e})')
+                    once = False
+            await asyncio.sleep(self.options.connect_wait)
+
+    async def _send(self, sendargs):
+        protocol = self.protocol
+        if not protocol or not protocol.alive:
+            return  # Sent again after reconnecting.
+        protocol.send(sendargs)
+        await protocol.drain()
+
+    def _recv(self, data):
+        assert len(data) >= 16, 'Unexpectedly short response'
+        reqnum = bytes(data[:8])
+        status = int.from_bytes(data[8:16], 'little', signed=False)
+        future = self.futures.get(reqnum)
+        if not future or future.done():
+            return  # The caller stopped waiting for the result.
+        if status == 0:
+            future.set_result(packlib.unpack(data[16:]))
+        else:
+            message = bytes(data[16:]).decode('utf-8')
+            future.set_exception(RuntimeError(message))
+
+    def _disconnected(self, exc):
+        detail = f'{type(exc).__name__}: {exc}' if exc else 'closed'
+        self._log(f'Connection to server lost ({detail})')
+        self.protocol = None
+        if self.closed:
+            return
+        if self.options.autoconn:
+            # Pending requests are sent again once we are reconnected, which
+            # matches the behavior of the threaded client.
+            asyncio.ensure_future(self._resend())
+        else:
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(client_socket.Disconnected())
+
+    async def _resend(self):
+        await self._ensure()
+        for future in list(self.futures.values()):
+            if not future.done():
+                await self._send(future.sendargs)
+
+    def _log(self, *args):
+        if not self.options.logging:
+            return
+        contextlib.context.print(
+            self.name, *args, color=self.options.logging_color
+        )
+
+
+class Protocol(asyncio.BufferedProtocol):
+    # Speaks the same length-prefixed wire protocol as the client socket.
+    # Received bytes go directly into the receive ring, so messages are
+    # parsed and reassembled the same way.
+
+    def __init__(self, client):
+        self.client = client
+        self.recvbuf = buffers.RecvRing(client.options.max_msg_size)
+        self.transport = None
+        self.alive = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.ready = asyncio.get_running_loop().create_future()
+        self.codec = None
+        self.ack = None  # Receives the reply to our codec offer.
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.alive = True
+        client = self.client
+        handshake = client.options.handshake.encode('utf-8')
+        if client.codec and not client.codecfailed:
+            # Offer our codec first and send the regular handshake once the
+            # server replied, like the client socket does.
+            offer = f'{client.codec} {client.codec_minsize}'.encode('utf-8')
+            size = len(offer).to_bytes(8, 'little')
+            transport.write(b'codec_' + handshake + size + offer)
+            self.ack = bytearray(1)
+        else:
+            transport.write(handshake)
+            self.ready.set_result(None)
+
+    def get_buffer(self, sizehint):
+        if self.ack is not None:
+            return self.ack
+        return self.recvbuf.target()
+
+    def buffer_updated(self, nbytes):
+        if self.ack is not None:
+            self.codec = self.client.codec if self.ack[0] == 1 else None
+            self.ack = None
+            self.transport.write(self.client.options.handshake.encode('utf-8'))
+            self.ready.set_result(None)
+            return
+        for message in self.recvbuf.advance(nbytes):
+            self.client._recv(message)
+
+    def send(self, parts):
+        buf = buffers.SendBuffer(*parts)
+        self.transport.writelines(buf.buffers)
+
+    async def drain(self):
+        await self.writable.wait()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def connection_lost(self, exc):
+        self.alive = False
+        self.writable.set()
+        if not self.ready.done():
+            # Servers that do not know the codec handshake close the
+            # connection, in which case we connect again without compression.
+            self.client.codecfailed = self.ack is not None
+            self.ready.set_exception(ConnectionError('Handshake failed'))
+            return
+        self.client._disconnected(exc)
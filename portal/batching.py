@@ -104,7 +104,13 @@ def batcher(
         if name not in batsizes:
             send_error(addr, reqnum, 3, f'Unknown method {name}')
             return
-        data = packlib.unpack(data)
+        try:
+            data = packlib.unpack(data, schemas)
+        except packlib.UnknownSchema:
+            # The client sends the request again with its structure.
+            status = int(7).to_bytes(8, 'little', signed=False)
+            outer.send(addr, reqnum, status, b'Unknown schema')
+            return
         batch_size = batsizes[name]
         if not batch_size:
             job = inner.call(name, *data)
@@ -167,10 +173,10 @@ def batcher(
             if batched:
                 for i, (addr, reqnum) in enumerate(zip(addr, reqnum)):
                     data = packlib.tree_map(lambda x: x[i], result)
-                    data = packlib.pack(data)
+                    data = packlib.pack(data, *outer.codec(addr))
                     outer.send(addr, reqnum, status, *data)
             else:
-                data = packlib.pack(result)
+                data = packlib.pack(result, *outer.codec(addr))
                 outer.send(addr, reqnum, status, *data)
         return waiting
 
@@ -187,7 +193,9 @@ def batcher(
             outer_port, f'{name}Server', **kwargs
         )
         inner = client.Client(inner_port, f'{name}Client', **kwargs)
-        batches = {}  # {method: ([addr], [reqnum], structure, [array])}
+        # {method: ([addr], [reqnum], structure, [array])}
+        batches = {}
+        schemas = packlib.SchemaCache()
         jobs = []
         shutdown = False
         while running.is_set() or jobs:
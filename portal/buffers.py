@@ -1,32 +1,160 @@
 import collections
+import ctypes
+import ctypes.util
+import functools
+import itertools
+import mmap
 import os
+import threading
+import time
 import weakref
 
 import numpy as np
 
 
-class SendBuffer:
-    def __init__(self, *buffers, maxsize=None):
-        for buffer in buffers:
-            types = (bytes, bytearray, memoryview)
-            assert isinstance(buffer, types), type(buffer)
-            assert not isinstance(buffer, memoryview) or buffer.c_contiguous
-        buffers = tuple(
-            x.cast('c') if isinstance(x, memoryview) else x for x in buffers
-        )
-        length = sum(len(x) for x in buffers)
-        assert all(len(x) for x in buffers)
-        assert 1 <= length, length
-        assert not maxsize or length <= length, (length, maxsize)
-        lenbuf = length.to_bytes(8, 'little', signed=False)
-        self.buffers = [lenbuf, *buffers]
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Messages larger than the frame size are split into fragments that can be
+# interleaved with other messages on the same connection. The length field of
+# a fragment has its highest bit set and is followed by the stream id and the
+# total length of the message.
+FRAGMENT = 1 << 63
+FRAGMENT_HEADER = 24
+
+# A message can also be split into byte ranges that are sent over separate
+# connections. Fragments of these stripes have both bits set and are followed
+# by the stream id, the total length of the message, and their offset into it.
+STRIPE = 1 << 62
+STRIPE_HEADER = 32
+
+HUGEPAGE = 2 * 1024**2
+MADV_POPULATE_WRITE = getattr(mmap, 'MADV_POPULATE_WRITE', 23)
+
+
+def sendmany(sock, sendbufs, maxbytes=16 * 1024**2):
+    # Gathers the remaining parts of the queued send buffers into a single
+    # writev() call, up to the limit on the number of iovecs and a byte budget
+    # after which no further buffers are added. Returns the number of bytes
+    # written and the number of bytes attempted to write. The queue may grow
+    # concurrently, so we index into it instead of iterating over it.
+    iovecs, count, total = [], 0, 0
+    for i in range(len(sendbufs)):
+        if len(iovecs) >= IOV_MAX or total >= maxbytes:
+            break
+        parts = sendbufs[i].iovecs()[: IOV_MAX - len(iovecs)]
+        iovecs += parts
+        total += sum(len(x) for x in parts)
+        count += 1
+    if hasattr(sock, 'writev'):
+        size = sock.writev(iovecs)
+    else:
+        size = os.writev(sock.fileno(), iovecs)
+    if size == 0:
+        raise ConnectionResetError
+    excess = size
+    for i in range(count):
+        excess = sendbufs[i].advance(excess)
+        if not excess:
+            break
+    return size, total
+
+
+class SendQueue:
+    def __init__(self, framesize=0):
+        # Messages are appended by user threads and scheduled into frames by
+        # the socket thread. Higher priorities are always sent first. Within
+        # a priority, messages take turns one frame at a time, so that small
+        # messages do not wait for large transfers queued before them. Only
+        # about one frame size worth of frames is scheduled ahead, so that
+        # newly arriving messages can overtake quickly.
+        self.framesize = framesize
+        self.incoming = collections.deque()  # [(priority, SendBuffer)]
+        self.classes = {}  # {priority: deque of frame iterators}
+        self.frames = collections.deque()  # [Frame]
+        self.streams = itertools.count(1)
+        self.active = 0  # Messages that left incoming but are not sent yet.
+        self.scheduled = 0  # Bytes of the scheduled frames.
+
+    def __len__(self):
+        return len(self.incoming) + self.active
+
+    def __bool__(self):
+        return bool(len(self))
+
+    def append(self, buf, priority=0):
+        self.incoming.append((priority, buf))
+
+    def schedule(self):
+        # Returns the frames to pass to sendmany().
+        while self.incoming:
+            priority, buf = self.incoming.popleft()
+            self.active += 1
+            if self.framesize and buf.length > self.framesize:
+                source = buf.frames(self.framesize, next(self.streams))
+            else:
+                source = iter((buf,))
+            if priority not in self.classes:
+                self.classes[priority] = collections.deque()
+            self.classes[priority].append(source)
+        while self.classes:
+            if self.framesize and self.scheduled >= self.framesize:
+                break
+            priority = max(self.classes)
+            sources = self.classes[priority]
+            source = sources.popleft()
+            frame = next(source, None)
+            if frame is None:
+                sources or self.classes.pop(priority)
+                continue
+            self.frames.append(frame)
+            self.scheduled += frame.size
+            if not frame.last:
+                sources.append(source)
+            elif not sources:
+                self.classes.pop(priority)
+        return self.frames
+
+    def release(self):
+        # Removes frames that were sent completely and returns the number of
+        # messages that were completed by them.
+        count = 0
+        while self.frames and self.frames[0].done():
+            frame = self.frames.popleft()
+            self.scheduled -= frame.size
+            if frame.last:
+                self.active -= 1
+                count += 1
+        return count
+
+    def clear(self):
+        # Drops all messages and returns how many were dropped.
+        count = self.active
+        while self.incoming:
+            self.incoming.popleft()
+            count += 1
+        self.classes.clear()
+        self.frames.clear()
+        self.active = 0
+        self.scheduled = 0
+        return count
+
+
+class Frame:
+    def __init__(self, buffers, last=True):
+        self.buffers = buffers
+        self.size = sum(len(x) for x in buffers)
+        self.last = last  # Whether this frame completes a message.
         self.remaining = collections.deque(self.buffers)
         self.pos = 0
 
     def __repr__(self):
         lens = [len(x) for x in self.buffers]
         left = [len(x) for x in self.remaining]
-        return f'SendBuffer(pos={self.pos}, lengths={lens} remaining={left})'
+        name = type(self).__name__
+        return f'{name}(pos={self.pos}, lengths={lens} remaining={left})'
 
     def reset(self):
         self.remaining = collections.deque(self.buffers)
@@ -36,23 +164,113 @@ class SendBuffer:
         first, *others = self.remaining
         assert self.pos < len(first)
         # The writev() call blocks but seems to be slightly faster than sendmsg().
-        size = os.writev(
-            sock.fileno(), [memoryview(first)[self.pos :], *others]
-        )
+        size = os.writev(sock.fileno(), self.iovecs()[:IOV_MAX])
         # size = sock.sendmsg(
         #     [memoryview(first)[self.pos:], *others], (), socket.MSG_DONTWAIT)
         if size == 0:
             raise ConnectionResetError
         assert 0 <= size, size
-        self.pos += max(0, size)
+        self.advance(size)
+        return size
+
+    def iovecs(self):
+        first, *others = self.remaining
+        return [memoryview(first)[self.pos :], *others]
+
+    def advance(self, size):
+        # Marks up to the given number of bytes as sent and returns the number
+        # of bytes that exceeded the remaining length of this buffer.
+        self.pos += size
         while self.remaining and self.pos >= len(self.remaining[0]):
             self.pos -= len(self.remaining.popleft())
-        return size
+        if self.remaining:
+            return 0
+        excess, self.pos = self.pos, 0
+        return excess
 
     def done(self):
         return not self.remaining
 
 
+class SendBuffer(Frame):
+    def __init__(self, *buffers, maxsize=None):
+        for buffer in buffers:
+            types = (bytes, bytearray, memoryview)
+            assert isinstance(buffer, types), type(buffer)
+            assert not isinstance(buffer, memoryview) or buffer.c_contiguous
+        buffers = tuple(
+            x.cast('c') if isinstance(x, memoryview) else x for x in buffers
+        )
+        length = sum(len(x) for x in buffers)
+        assert all(len(x) for x in buffers)
+        assert 1 <= length, length
+        assert not maxsize or length <= length, (length, maxsize)
+        lenbuf = length.to_bytes(8, 'little', signed=False)
+        self.length = length
+        super().__init__([lenbuf, *buffers])
+
+    def frames(self, framesize, stream):
+        # Lazily splits the message into fragments of up to the frame size
+        # that view into the original buffers.
+        suffix = stream.to_bytes(8, 'little', signed=False)
+        suffix += self.length.to_bytes(8, 'little', signed=False)
+        sent = 0
+        for parts, size in split(self.buffers[1:], framesize):
+            header = (FRAGMENT | size).to_bytes(8, 'little')
+            sent += size
+            yield Frame([header + suffix, *parts], sent == self.length)
+
+    def stripes(self, count, stream):
+        # Splits the message into up to the given number of contiguous byte
+        # ranges that can be sent over separate connections.
+        stripes, offset = [], 0
+        for parts, size in split(self.buffers[1:], -(-self.length // count)):
+            stripes.append(Stripe(parts, stream, self.length, offset))
+            offset += size
+        return stripes
+
+
+class Stripe(Frame):
+    def __init__(self, parts, stream, total, offset):
+        self.length = sum(len(x) for x in parts)
+        self.stream = stream
+        self.total = total
+        self.offset = offset
+        self.parts = parts
+        super().__init__([self._header(self.length, offset), *parts])
+
+    def frames(self, framesize, stream):
+        # The stream id of the stripe is used instead of the one assigned by
+        # the connection, so that the receiver can combine the stripes.
+        offset = self.offset
+        for parts, size in split(self.parts, framesize):
+            header = self._header(size, offset)
+            offset += size
+            yield Frame([header, *parts], offset == self.offset + self.length)
+
+    def _header(self, size, offset):
+        fields = (FRAGMENT | STRIPE | size, self.stream, self.total, offset)
+        return b''.join(x.to_bytes(8, 'little') for x in fields)
+
+
+def split(buffers, size):
+    # Lazily yields lists of views into the buffers that hold up to the given
+    # number of bytes each, together with their total size.
+    parts, total = [], 0
+    for buffer in buffers:
+        view, pos = memoryview(buffer), 0
+        while pos < len(view):
+            part = view[pos : pos + size - total]
+            parts.append(part)
+            total += len(part)
+            pos += len(part)
+            if total == size:
+                yield parts, total
+                parts, total = [], 0
+    if parts:
+        yield parts, total
+
+
 class RecvBuffer:
     def __init__(self, maxsize):
         self.maxsize = maxsize
@@ -72,14 +290,7 @@ class RecvBuffer:
             if len(self.lenbuf) == 8:
                 length = int.from_bytes(self.lenbuf, 'little', signed=False)
                 assert 1 <= length <= self.maxsize, (1, length, self.maxsize)
-                # We use Numpy to allocate uninitialized memory because Python's
-                # `bytearray(length)` zero initializes which is slow. This also means
-                # the buffer cannot be pickled accidentally unless explicitly converted
-                # to a `bytes()` object, which is a nice bonus for preventing
-                # performance bugs in user code.
-                arr = np.empty(length, np.uint8)
-                self.buffer = memoryview(arr.data)
-                weakref.finalize(self.buffer, lambda arr=arr: arr)
+                self.buffer = allocate(length)
                 self.pos = 0
         else:
             size = sock.recv_into(self.buffer[self.pos :])
@@ -95,3 +306,426 @@ class RecvBuffer:
 
     def result(self):
         return self.buffer
+
+
+class RecvRing:
+    def __init__(
+        self,
+        maxsize,
+        chunksize=64 * 1024,
+        pool=None,
+        hugepages=0,
+        prefault=False,
+        stripes=None,
+    ):
+        self.maxsize = maxsize
+        self.chunksize = chunksize
+        if pool:
+            self.allocate = functools.partial(
+                pool.allocate, hugepages=hugepages, prefault=prefault
+            )
+        else:
+            self.allocate = functools.partial(
+                allocate, hugepages=hugepages, prefault=prefault
+            )
+        self.chunk = None
+        self.start = 0  # Start of the first incomplete message in the chunk.
+        self.end = 0  # End of the received bytes in the chunk.
+        self.shared = False  # Whether returned messages view into the chunk.
+        self.buffer = None  # Separate buffer for a large message.
+        self.pos = 0
+        self.stream = None  # Fragment that the separate buffer belongs to.
+        self.streams = {}  # {stream: [buffer, pos]}
+        self.stripes = stripes  # Shared with other connections.
+        self.nonces = set()  # Current nonce of the stripes received by us.
+
+    def __repr__(self):
+        length = self.buffer and len(self.buffer)
+        return (
+            f'RecvRing(start={self.start}, end={self.end}, '
+            + f'pos={self.pos}, length={length})'
+        )
+
+    def recv(self, sock):
+        # Reads as many bytes as are available up to the chunk size and
+        # returns all messages that were completed by them. Small messages are
+        # returned as views into the chunk. Messages that do not fit into a
+        # chunk are received directly into their own buffer.
+        size = sock.recv_into(self.target())
+        if size == 0:
+            raise ConnectionResetError
+        return self.advance(size)
+
+    def target(self):
+        # Returns the memory to receive the next bytes into.
+        if self.buffer is not None:
+            return self.buffer[self.pos :]
+        if self.chunk is None:
+            self.chunk = self.allocate(self.chunksize)
+        elif self.end == self.chunksize:
+            self._compact()
+        return self.chunk[self.end :]
+
+    def advance(self, size):
+        # Accounts for bytes received into the target and returns the
+        # messages that were completed by them.
+        if self.buffer is not None:
+            self.pos += size
+            if self.pos < len(self.buffer):
+                return []
+            message, self.buffer = self.buffer, None
+            if self.stream is None:
+                return [message]
+            stream, self.stream = self.stream, None
+            return self._assemble(stream, len(message))
+        self.end += size
+        return self._parse()
+
+    def _parse(self):
+        messages = []
+        while True:
+            header = self._header()
+            if not header:
+                break
+            headsize, length, fragment = header
+            begin = self.start + headsize
+            if begin + length <= self.end:
+                data = self.chunk[begin : begin + length]
+                if fragment is None:
+                    messages.append(data)
+                    self.shared = True
+                else:
+                    self._target(fragment, length)[:] = data
+                    messages += self._assemble(fragment, length)
+                self.start = begin + length
+            elif headsize + length > self.chunksize:
+                if fragment is None:
+                    self.buffer = self.allocate(length)
+                else:
+                    self.buffer = self._target(fragment, length)
+                    self.stream = fragment
+                self.pos = self.end - begin
+                self.buffer[: self.pos] = self.chunk[begin : self.end]
+                self.start = self.end
+                break
+            else:
+                break
+        if self.start == self.end and not self.shared:
+            self.start = self.end = 0
+        elif self.start + self._pending() > self.chunksize:
+            self._compact()
+        return messages
+
+    def _header(self):
+        # Returns the header size, payload length, and fragment of the next
+        # frame, or None if its header is incomplete. The fragment is None for
+        # whole messages and otherwise holds the stream id, message length,
+        # and the offset for stripes.
+        available = self.end - self.start
+        if available < 8:
+            return None
+        value = self._int(self.start)
+        if not value & FRAGMENT:
+            assert 1 <= value <= self.maxsize, (1, value, self.maxsize)
+            return 8, value, None
+        headsize = STRIPE_HEADER if value & STRIPE else FRAGMENT_HEADER
+        if available < headsize:
+            return None
+        length = value & ~(FRAGMENT | STRIPE)
+        stream = self._int(self.start + 8)
+        total = self._int(self.start + 16)
+        assert 1 <= length <= total <= self.maxsize, (length, total)
+        offset = None
+        if value & STRIPE:
+            assert self.stripes is not None, 'Unexpected stripe'
+            offset = self._int(self.start + 24)
+            assert offset + length <= total, (offset, length, total)
+        return headsize, length, (stream, total, offset)
+
+    def _int(self, pos):
+        return int.from_bytes(self.chunk[pos : pos + 8], 'little')
+
+    def _pending(self):
+        header = self._header()
+        if not header:
+            return FRAGMENT_HEADER
+        return header[0] + header[1]
+
+    def _target(self, fragment, length):
+        # Returns the part of the message buffer for the next fragment.
+        stream, total, offset = fragment
+        if offset is not None:
+            return self.stripes.target(self, stream, total, offset, length)
+        if stream not in self.streams:
+            self.streams[stream] = [self.allocate(total), 0]
+        buffer, pos = self.streams[stream]
+        assert len(buffer) == total and pos + length <= total, (pos, total)
+        return buffer[pos : pos + length]
+
+    def _assemble(self, fragment, length):
+        stream, _, offset = fragment
+        if offset is not None:
+            return self.stripes.assemble(stream, length)
+        entry = self.streams[stream]
+        entry[1] += length
+        if entry[1] < len(entry[0]):
+            return []
+        del self.streams[stream]
+        return [entry[0]]
+
+    def _compact(self):
+        # Returned messages are views into the chunk, so we move the partial
+        # message to a new chunk instead of overwriting the current one.
+        rest = bytes(self.chunk[self.start : self.end])
+        if self.shared:
+            self.chunk = self.allocate(self.chunksize)
+            self.shared = False
+        self.chunk[: len(rest)] = rest
+        self.start, self.end = 0, len(rest)
+
+
+class Stripes:
+    """
+    Reassembles messages whose byte ranges arrive over separate connections:
+
+    1. The receive buffers of all connections share this object. Each stripe
+    fragment is received directly into its offset of one buffer per stream,
+    and the message is returned by the connection that completes it.
+
+    2. The upper half of the stream id is a random nonce of the sender. When
+    a connection is lost, the partial messages of all senders that used it
+    are dropped, because their missing ranges will not arrive anymore. The
+    sender switches to a new nonce before it sends the messages again.
+
+    3. A connection can also be lost before any stripe of a partial message
+    arrived on it. Its sender then uses a new nonce on its other connections,
+    so a connection that sees a new nonce drops the nonces it saw before.
+
+    4. Fragments of dropped senders that were still in flight on their other
+    connections are received into scratch buffers and discarded.
+    """
+
+    def __init__(self, maxdropped=1024):
+        self.entries = {}  # {stream: [buffer, received]}
+        self.dropped = collections.deque(maxlen=maxdropped)  # [nonce]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def target(self, ring, stream, total, offset, length):
+        nonce = stream >> 32
+        with self.lock:
+            if nonce in self.dropped:
+                return ring.allocate(length)
+            if nonce not in ring.nonces:
+                self._drop(ring)
+                ring.nonces.add(nonce)
+            if stream not in self.entries:
+                self.entries[stream] = [ring.allocate(total), 0]
+            buffer = self.entries[stream][0]
+        assert len(buffer) == total, (len(buffer), total)
+        return buffer[offset : offset + length]
+
+    def assemble(self, stream, length):
+        with self.lock:
+            entry = self.entries.get(stream)
+            if not entry:
+                return []  # The sender was dropped.
+            entry[1] += length
+            if entry[1] < len(entry[0]):
+                return []
+            del self.entries[stream]
+        return [entry[0]]
+
+    def drop(self, ring):
+        # Drops the partial messages of all senders that used the connection.
+        with self.lock:
+            self._drop(ring)
+
+    def _drop(self, ring):
+        if not ring.nonces:
+            return
+        for nonce in ring.nonces:
+            nonce in self.dropped or self.dropped.append(nonce)
+        for stream in list(self.entries):
+            if stream >> 32 in ring.nonces:
+                del self.entries[stream]
+        ring.nonces.clear()
+
+
+def allocate(length, hugepages=0, prefault=False):
+    # We use Numpy to allocate uninitialized memory because Python's
+    # `bytearray(length)` zero initializes which is slow. This also means the
+    # buffer cannot be pickled accidentally unless explicitly converted to a
+    # `bytes()` object, which is a nice bonus for preventing performance bugs
+    # in user code.
+    arr = empty(length, hugepages, prefault)
+    buffer = memoryview(arr.data)
+    weakref.finalize(buffer, lambda arr=arr: arr)
+    return buffer
+
+
+def empty(length, hugepages=0, prefault=False):
+    # Buffers of at least the hugepages size are mapped separately and backed
+    # by transparent huge pages where available, so that filling them takes
+    # one page fault per 2 MiB instead of per 4 KiB. Optionally, a background
+    # thread faults in the pages ahead of the socket writing into them.
+    if not hugepages or length < hugepages:
+        return np.empty(length, np.uint8)
+    size = -(-length // HUGEPAGE) * HUGEPAGE
+    flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+    mapping = mmap.mmap(-1, size, flags=flags)
+    if hasattr(mmap, 'MADV_HUGEPAGE'):
+        mapping.madvise(mmap.MADV_HUGEPAGE)
+    arr = np.frombuffer(mapping, np.uint8)[:length]
+    if prefault:
+        threading.Thread(target=_populate, args=(arr,), daemon=True).start()
+    return arr
+
+
+@functools.cache
+def _libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+
+def _populate(arr, step=64 * 1024**2):
+    # Unlike touching the pages, this does not write to them and thus cannot
+    # race with data that is being received. Calls through ctypes release the
+    # GIL. Older kernels do not support this and we simply stop.
+    libc = _libc()
+    if not libc:
+        return
+    start = arr.ctypes.data
+    for offset in range(0, len(arr), step):
+        length = min(step, len(arr) - offset)
+        if libc.madvise(
+            ctypes.c_void_p(start + offset),
+            ctypes.c_size_t(length),
+            MADV_POPULATE_WRITE,
+        ):
+            return
+
+
+class BufferPool:
+    """
+    Recycles receive buffers instead of allocating fresh memory per message:
+
+    1. Requests are rounded up to size classes with four steps per power of
+    two, so that at most a quarter of a buffer is wasted.
+
+    2. A buffer returns to the free list of its class once the last view into
+    it is released, including memoryview slices and Numpy arrays created from
+    it, such as the arrays returned by `packlib.unpack()`.
+
+    3. The pool owns at most `maxbytes` of memory, counting both buffers in
+    use and free ones. When a new buffer would exceed the cap, free buffers
+    of other classes are evicted first. If that is not enough, the buffer is
+    allocated outside of the pool and not recycled.
+
+    4. Free buffers of size classes that were not allocated from for
+    `maxidle` seconds are evicted, so that memory is returned after a burst
+    of large messages.
+
+    5. Sockets share one pool per process via `BufferPool.shared()`, so that
+    the cap holds across all connections of all clients and servers.
+
+    Recycled buffers are already backed by physical pages, so reusing them
+    also avoids page faults when receiving into them.
+    """
+
+    instance = None
+    instlock = threading.Lock()
+
+    @classmethod
+    def shared(cls, maxbytes):
+        # Returns the pool of the process. Its cap is the largest one that was
+        # requested so far.
+        with cls.instlock:
+            if not cls.instance:
+                cls.instance = cls(maxbytes)
+            pool = cls.instance
+        with pool.lock:
+            pool.maxbytes = max(pool.maxbytes, maxbytes)
+        return pool
+
+    def __init__(self, maxbytes, minsize=4096, maxidle=10.0):
+        self.maxbytes = maxbytes
+        self.minsize = minsize
+        self.maxidle = maxidle
+        self.free = collections.defaultdict(list)  # {size: [array]}
+        self.used = {}  # {size: time of last allocation}
+        self.trimmed = time.monotonic()
+        self.refs = {}  # Keeps the weak references alive.
+        self.owned = 0
+        self.cached = 0
+        self.numhits = 0
+        self.nummisses = 0
+        # Buffers can be released by any thread, including this one while it
+        # holds the lock.
+        self.lock = threading.RLock()
+
+    def allocate(self, length, hugepages=0, prefault=False):
+        size = self.sizeclass(length)
+        now = time.monotonic()
+        with self.lock:
+            self.used[size] = now
+            if now - self.trimmed >= min(1.0, self.maxidle):
+                self._trim(now)
+            if self.free[size]:
+                arr = self.free[size].pop()
+                self.cached -= size
+                self.numhits += 1
+            elif self._reserve(size):
+                arr = None
+                self.nummisses += 1
+            else:
+                self.nummisses += 1
+                return allocate(length, hugepages, prefault)
+        if arr is None:
+            arr = empty(size, hugepages, prefault)
+        view = arr[:length]
+        ref = weakref.ref(view, lambda ref: self._release(ref, arr))
+        self.refs[id(ref)] = ref
+        return view.data
+
+    def sizeclass(self, length):
+        length = max(length, self.minsize)
+        step = 1 << max(0, (length - 1).bit_length() - 3)
+        return -(-length // step) * step
+
+    def clear(self):
+        with self.lock:
+            self.owned -= self.cached
+            self.cached = 0
+            self.free.clear()
+
+    def _trim(self, now):
+        self.trimmed = now
+        for size in list(self.free):
+            if now - self.used.get(size, 0) < self.maxidle:
+                continue
+            count = len(self.free.pop(size))
+            self.owned -= count * size
+            self.cached -= count * size
+
+    def _reserve(self, size):
+        if self.owned + size > self.maxbytes:
+            for other in sorted(self.free, key=lambda x: -x):
+                while self.free[other] and self.owned + size > self.maxbytes:
+                    self.free[other].pop()
+                    self.owned -= other
+                    self.cached -= other
+        if self.owned + size > self.maxbytes:
+            return False
+        self.owned += size
+        return True
+
+    def _release(self, ref, arr):
+        self.refs.pop(id(ref), None)
+        with self.lock:
+            self.free[len(arr)].append(arr)
+            self.cached += len(arr)
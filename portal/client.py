@@ -1,19 +1,40 @@
 import collections
 import functools
 import itertools
+import random
 import threading
 import time
 import weakref
 
+from . import buffers
 from . import client_socket
+from . import codecs
 from . import futures
 from . import packlib
 
 
 class Client:
-    def __init__(self, addr, name='Client', maxinflight=16, **kwargs):
+    def __init__(
+        self,
+        addr,
+        name='Client',
+        maxinflight=16,
+        connections=1,
+        stripe_size=64 * 1024**2,
+        codec=None,
+        codec_minsize=64 * 1024,
+        schemas=True,
+        **kwargs,
+    ):
         assert 1 <= maxinflight, maxinflight
+        assert 1 <= connections, connections
         self.maxinflight = maxinflight
+        self.stripe_size = stripe_size
+        assert not codec or codecs.available(codec), codec
+        self.codec = codec
+        self.codec_minsize = codec_minsize
+        # Repeated argument structures are sent as schema ids.
+        self.schemas = packlib.Schemas() if schemas else None
         self.reqnum = iter(itertools.count(0))
         self.futures = {}
         self.errors = collections.deque()
@@ -22,19 +43,35 @@ class Client:
         self.waitmean = [0, 0]
         self.cond = threading.Condition()
         self.lock = threading.Lock()
-        # Socket is created after the above attributes because the callbacks access
-        # some of the attributes.
-        self.socket = client_socket.ClientSocket(
-            addr, name, start=False, **kwargs
-        )
-        self.socket.callbacks_recv.append(self._recv)
-        self.socket.callbacks_disc.append(self._disc)
-        self.socket.callbacks_conn.append(self._conn)
-        self.socket.start()
+        # Requests are spread over one or more connections to the server. The
+        # server replies on the connection that a request arrived on.
+        self.outstanding = [0] * connections  # Request bytes per connection.
+        # Requests of at least the stripe size are instead split into byte
+        # ranges that are sent over all connections at the same time.
+        self.nonce = random.getrandbits(32)
+        self.streams = iter(itertools.count(0))
+        # Sockets are created after the above attributes because the callbacks
+        # access some of the attributes.
+        self.sockets = []
+        for index in range(connections):
+            socket = client_socket.ClientSocket(
+                addr,
+                name,
+                start=False,
+                codec=codec,
+                codec_minsize=codec_minsize,
+                **kwargs,
+            )
+            socket.callbacks_recv.append(functools.partial(self._recv, index))
+            socket.callbacks_disc.append(functools.partial(self._disc, index))
+            socket.callbacks_conn.append(functools.partial(self._conn, index))
+            self.sockets.append(socket)
+        self.socket = self.sockets[0]
+        [socket.start() for socket in self.sockets]
 
     @property
     def connected(self):
-        return self.socket.connected
+        return all(socket.connected for socket in self.sockets)
 
     def __getattr__(self, name):
         if name.startswith('_'):
@@ -54,6 +91,7 @@ class Client:
             'recvrate': self.recvrate[0] / (now - self.recvrate[1]),
             'waitmean': self.waitmean[0]
             and (self.waitmean[1] / self.waitmean[0]),
+            'pausetime': sum(socket.pausetime for socket in self.sockets),
         }
         self.sendrate = [0, now]
         self.recvrate = [0, now]
@@ -61,18 +99,19 @@ class Client:
         return stats
 
     def connect(self, timeout=None):
-        return self.socket.connect(timeout)
+        return all([socket.connect(timeout) for socket in self.sockets])
 
-    def call(self, method, *data):
+    def call(self, method, *data, priority=0):
         reqnum = next(self.reqnum).to_bytes(8, 'little', signed=False)
         start = time.time()
         while len(self.futures) >= self.maxinflight:
             with self.cond:
                 self.cond.wait(timeout=0.2)
-            try:
-                self.socket.require_connection(timeout=0)
-            except TimeoutError:
-                pass
+            for socket in self.sockets:
+                try:
+                    socket.require_connection(timeout=0)
+                except TimeoutError:
+                    pass
         with self.lock:
             self.waitmean[1] += time.time() - start
             self.waitmean[0] += 1
@@ -81,16 +120,28 @@ class Client:
             raise self.errors.popleft()
         name = method.encode('utf-8')
         strlen = len(name).to_bytes(8, 'little', signed=False)
-        sendargs = (reqnum, strlen, name, *packlib.pack(data))
+        if self.schemas:
+            packed, schema = self.schemas.pack(data, *self._codec())
+        else:
+            packed = packlib.pack(data, *self._codec())
+            schema = None
+        sendargs = (reqnum, strlen, name, *packed)
         future = futures.Future()
         future.sendargs = sendargs
+        # Kept for sending the request again without schema id if needed.
+        future.data = data if self.schemas else None
+        future.schema = schema
+        future.priority = priority
+        future.size = sum(memoryview(x).nbytes for x in sendargs)
+        future.shares = {}  # {index: size}
         self.futures[reqnum] = future
         # Store future before sending request because the response may come fast
         # and the response handler runs in the socket's background thread.
         try:
-            self.socket.send(*sendargs)
+            self._send(future)
         except client_socket.Disconnected:
             future = self.futures.pop(reqnum)
+            self._done(future)
             future.rai[0] = True
             raise
         return future
@@ -99,45 +150,152 @@ class Client:
         for future in self.futures.values():
             self._seterr(future, client_socket.Disconnected)
         self.futures.clear()
-        self.socket.close(timeout)
+        [socket.close(timeout) for socket in self.sockets]
 
-    def _recv(self, data):
+    def _recv(self, index, data):
         assert len(data) >= 16, 'Unexpectedly short response'
         reqnum = bytes(data[:8])
         status = int.from_bytes(data[8:16], 'little', signed=False)
         future = self.futures.pop(reqnum, None)
+        future and self._done(future)
         if not future:
             existing = sorted(self.futures.keys())
             print(f'Unexpected request number: {reqnum}', existing)
         elif status == 0:
+            future.schema and self.schemas.confirm(future.schema)
             data = packlib.unpack(data[16:])
             future.set_result(data)
             with self.cond:
                 self.cond.notify_all()
+        elif status == 7 and future.data is not None:
+            # The server does not know the schema anymore, for example because
+            # it restarted, so we send the request again with its structure.
+            # This runs in the reactor thread, which serves other sockets as
+            # well, so errors are passed to the future instead of raised.
+            self.schemas.reset()
+            try:
+                packed = packlib.pack(future.data, *self._codec())
+                future.sendargs = (*future.sendargs[:3], *packed)
+                future.size = sum(
+                    memoryview(x).nbytes for x in future.sendargs
+                )
+                future.data = None
+                future.schema = None
+                self.futures[reqnum] = future
+                self._resend(future)
+            except Exception as e:
+                self.futures.pop(reqnum, None) and self._done(future)
+                self._seterr(future, e)
+                with self.cond:
+                    self.cond.notify_all()
         else:
             message = bytes(data[16:]).decode('utf-8')
             self._seterr(future, RuntimeError(message))
             with self.cond:
                 self.cond.notify_all()
         try:
-            self.socket.recv()
+            self.sockets[index].recv()
         except AssertionError:
             pass  # Socket is already closed.
 
-    def _disc(self):
+    def _send(self, future, timeout=None):
+        future.shares = {}
+        count = len(self.sockets)
+        if count > 1 and self.stripe_size and future.size >= self.stripe_size:
+            stream = (self.nonce << 32) | (next(self.streams) % 2**32)
+            buf = buffers.SendBuffer(*future.sendargs)
+            stripes = dict(enumerate(buf.stripes(count, stream)))
+            with self.lock:
+                for index, stripe in stripes.items():
+                    future.shares[index] = stripe.length
+                    self.outstanding[index] += stripe.length
+            for index, stripe in stripes.items():
+                self.sockets[index].send_buffer(
+                    stripe, timeout, priority=future.priority
+                )
+            return
+        with self.lock:
+            # Send on the connected socket with the fewest outstanding bytes.
+            # If none is connected, wait for any of them.
+            outstanding = self.outstanding
+            indices = [i for i in range(count) if self.sockets[i].connected]
+            indices = indices or range(count)
+            index = min(indices, key=outstanding.__getitem__)
+            future.shares[index] = future.size
+            outstanding[index] += future.size
+        self.sockets[index].send(
+            *future.sendargs, timeout=timeout, priority=future.priority
+        )
+
+    def _resend(self, future):
+        # Resends run in the reactor thread, which also establishes the
+        # connections, so they must not wait for one. If the connection is
+        # lost meanwhile, the request is sent again once it is back.
+        # Other errors are passed to the future instead of raised.
+        try:
+            self._send(future, timeout=0)
+            return
+        except (TimeoutError, client_socket.Disconnected) as e:
+            if self.socket.options.autoconn:
+                with self.lock:
+                    future.resend = True
+                return
+            error = e
+        except Exception as e:
+            error = e
+        self.futures.pop(future.sendargs[0], None) and self._done(future)
+        self._seterr(future, error)
+        with self.cond:
+            self.cond.notify_all()
+
+    def _disc(self, index):
+        # The server may have restarted and lost the schemas we sent.
+        self.schemas and self.schemas.reset()
+        if len(self.sockets) > 1:
+            # The server drops partial stripes of the old nonce.
+            self.nonce = random.getrandbits(32)
+        pending = {
+            reqnum: future
+            for reqnum, future in list(self.futures.items())
+            if index in future.shares
+        }
         if self.socket.options.autoconn:
-            for future in list(self.futures.values()):
+            for future in pending.values():
                 future.resend = True
         else:
-            for future in list(self.futures.values()):
+            for reqnum, future in pending.items():
+                self.futures.pop(reqnum, None)
+                self._done(future)
                 self._seterr(future, client_socket.Disconnected)
-            self.futures.clear()
 
-    def _conn(self):
-        if self.socket.options.autoconn:
-            for future in list(self.futures.values()):
-                if getattr(future, 'resend', False):
-                    self.socket.send(*future.sendargs)
+    def _conn(self, index):
+        if not self.socket.options.autoconn:
+            return
+        for future in list(self.futures.values()):
+            if index not in future.shares:
+                continue
+            # Stripes span all connections, so they are sent again once the
+            # last connection is back.
+            if len(future.shares) > 1 and not self.connected:
+                continue
+            with self.lock:
+                resend = getattr(future, 'resend', False)
+                future.resend = False
+            if resend:
+                self._done(future)
+                self._resend(future)
+
+    def _codec(self):
+        # Requests are only compressed once the server accepted the codec on
+        # all connections, because a request may be sent over any of them.
+        if all(socket.codec == self.codec for socket in self.sockets):
+            return self.codec, self.codec_minsize
+        return None, self.codec_minsize
+
+    def _done(self, future):
+        with self.lock:
+            for index, size in future.shares.items():
+                self.outstanding[index] -= size
 
     def _seterr(self, future, e):
         future.set_error(e)
@@ -8,9 +8,14 @@ import sys
 import threading
 import time
 
+from . import addrlib
 from . import buffers
 from . import contextlib
+from . import shmpipe
 from . import thread
+from . import tuning
+from . import wakeup
+from . import zerocopy
 
 
 class Disconnected(Exception):
@@ -31,17 +36,32 @@ class Options:
     logging_color: str = 'yellow'
     connect_wait: float = 0.1
     handshake: str = 'portal_handshake'
+    profile: str = 'auto'
+    sndbuf: int = 0
+    rcvbuf: int = 0
+    unix_upgrade: bool = False
+    shm_ring: int = 0
+    frame_size: int = 1024**2
+    zerocopy: int = 0
+    pool_size: int = 64 * 1024**2
+    hugepages: int = 0
+    prefault: bool = False
+    reactors: int = 0
 
 
 class ClientSocket:
-    def __init__(self, addr, name='Client', start=True, **kwargs):
-        addr = str(addr)
-        assert '://' not in addr, addr
-        host, port = addr.rsplit(':', 1) if ':' in addr else ('', addr)
+    def __init__(
+        self,
+        addr,
+        name='Client',
+        start=True,
+        codec=None,
+        codec_minsize=64 * 1024,
+        **kwargs,
+    ):
         self.name = name
         self.options = Options(**{**contextlib.context.clientkw, **kwargs})
-        host = host or ('::1' if self.options.ipv6 else '127.0.0.1')
-        self.addr = (host, port)
+        self.addr = addrlib.parse(addr, self.options.ipv6)
 
         self.callbacks_recv = []
         self.callbacks_conn = []
@@ -49,16 +69,45 @@ class ClientSocket:
 
         self.isconn = threading.Event()
         self.wantconn = threading.Event()
-        self.sendq = collections.deque()
+        self.sendq = buffers.SendQueue(self.options.frame_size)
         self.recvq = queue.Queue()
-        self.get_signal, self.set_signal = os.pipe()
+        self.pool = None
+        if self.options.pool_size:
+            self.pool = buffers.BufferPool.shared(self.options.pool_size)
+        self.tuning = None
+        self.zerocopy = None
+        self.channel = None
+        self.shmfailed = False
+        # The codec is offered to the server when connecting and only used
+        # once the server accepted it.
+        self.offer = codec and (codec, codec_minsize)
+        self.codec = None
+        self.codecfailed = False
+        self.paused = None  # Time at which reading was paused.
+        self.pausetime = 0.0  # Total seconds that reading was paused.
 
+        self.sock = None
+        self.recvbuf = None
+        self.events = 0  # Events the socket is registered for.
+        self.writable = True  # Whether the last write did not block.
+        self.connecting = False
+        self.abandoned = False
+        self.finished = threading.Event()
+
+        # Clients either run their own reactor thread or share one of a few
+        # reactor threads with all other clients in the process.
         self.running = True
-        self.thread = thread.Thread(self._loop, name=f'{name}Loop')
-        start and self.thread.start()
+        if self.options.reactors:
+            self.reactor = Reactor.shared(self.options.reactors)
+        else:
+            self.reactor = Reactor(f'{name}Loop')
+        self.started = False
+        start and self.start()
 
     def start(self):
-        self.thread.start()
+        assert not self.started
+        self.started = True
+        self.reactor.add(self)
 
     @property
     def connected(self):
@@ -67,19 +116,52 @@ class ClientSocket:
     def connect(self, timeout=None):
         if not self.options.autoconn:
             self.wantconn.set()
+            self.reactor.wake(self)
         return self.isconn.wait(timeout)
 
-    def send(self, *data, timeout=None):
+    def send(self, *data, timeout=None, priority=0):
+        maxsize = self.options.max_msg_size
+        buf = buffers.SendBuffer(*data, maxsize=maxsize)
+        self.send_buffer(buf, timeout, priority)
+
+    def send_buffer(self, buf, timeout=None, priority=0):
+        # Sends a prepared message or a stripe of one.
         assert self.running
         if len(self.sendq) > self.options.max_send_queue:
             raise RuntimeError('Too many outgoing messages enqueued')
         self.require_connection(timeout)
-        maxsize = self.options.max_msg_size
-        self.sendq.append(buffers.SendBuffer(*data, maxsize=maxsize))
-        os.write(self.set_signal, bytes(1))
+        self.tuning and self.tuning.sent(buf.length)
+        self.sendq.append(buf, priority)
+        self.reactor.wake(self)
 
     def recv(self, timeout=None):
         assert self.running
+        result = self._get(timeout)
+        if self.paused and self._drained():
+            self.reactor.wake(self)
+        return result
+
+    def close(self, timeout=None):
+        self.running = False
+        self.reactor.wake(self)
+        if self.reactor.dedicated:
+            self.reactor.thread.join(timeout)
+            self.reactor.thread.kill()
+            self.reactor.close()
+        elif not self.finished.wait(timeout):
+            # Give up on flushing the remaining messages.
+            self.abandoned = True
+            self.reactor.wake(self)
+
+    def require_connection(self, timeout):
+        if self.connected:
+            return
+        if not self.options.autoconn:
+            raise Disconnected
+        if timeout == 0 or not self.isconn.wait(timeout):
+            raise TimeoutError
+
+    def _get(self, timeout):
         try:
             if timeout is not None and timeout <= 0.2:
                 return self.recvq.get(block=(timeout != 0), timeout=timeout)
@@ -99,125 +181,149 @@ class ClientSocket:
         except queue.Empty:
             raise TimeoutError
 
-    def close(self, timeout=None):
-        self.running = False
-        self.thread.join(timeout)
-        self.thread.kill()
-        os.close(self.get_signal)
-        os.close(self.set_signal)
+    def _connected(self, sock):
+        self.sock = sock
+        self.recvbuf = self._recvbuf()
+        self.events = 0
+        self.writable = True
+        self.isconn.set()
+        if not self.options.autoconn:
+            self.wantconn.clear()
+        [x() for x in self.callbacks_conn]
 
-    def require_connection(self, timeout):
-        if self.connected:
+    def _wanted(self):
+        # Only wait for the socket to become writable after a write blocked.
+        # The shared memory pipe has no write readiness, so the server
+        # notifies us through the socket instead.
+        if not self.sock:
+            return 0
+        wanted = 0 if self.paused else select.POLLIN
+        if self.sendq and not self.writable and not self.channel:
+            wanted |= select.POLLOUT
+        return wanted
+
+    def _busy(self):
+        return bool(self.sock and self.sendq and self.writable)
+
+    def _done(self):
+        if self.running or self.connecting:
+            return False
+        return not (self.sock and self.sendq) or self.abandoned
+
+    def _step(self, revents):
+        if not self.sock:
             return
-        if not self.options.autoconn:
-            raise Disconnected
-        if timeout == 0 or not self.isconn.wait(timeout):
-            raise TimeoutError
+        sock = self.sock
+        try:
+            if revents & select.POLLOUT:
+                self.writable = True
+            if self.channel and revents & select.POLLIN:
+                self.writable = True
 
-    def _loop(self):
-        recvbuf = buffers.RecvBuffer(maxsize=self.options.max_msg_size)
-        sock = None
-        poll = select.poll()
-        poll.register(self.get_signal, select.POLLIN)
-        isconn = False  # Local mirror of self.isconn without the lock.
-        writing = False
-
-        while self.running or (self.sendq and isconn):
-            if not isconn:
-                if not self.options.autoconn and not self.wantconn.wait(
-                    timeout=0.2
-                ):
-                    continue
-                sock = self._connect()
-                if not sock:
-                    break
-                poll.register(sock, select.POLLIN)
-                self.isconn.set()
-                isconn = True
-                if not self.options.autoconn:
-                    self.wantconn.clear()
-                [x() for x in self.callbacks_conn]
+            if self.zerocopy.inflight:
+                self.zerocopy.reap()
 
-            try:
-                if not writing:
-                    fds = [fd for fd, _ in poll.poll(0.2)]
-                    if self.get_signal in fds:
-                        writing = True
-                        os.read(self.get_signal, 1)
+            if self.paused and self._drained():
+                self.pausetime += time.time() - self.paused
+                self.paused = None
 
+            if revents & (select.POLLIN | select.POLLHUP | select.POLLERR):
                 try:
-                    recvbuf.recv(sock)
-                    if recvbuf.done():
-                        if self.recvq.qsize() > self.options.max_recv_queue:
-                            message = 'Too many incoming messages enqueued'
-                            raise RuntimeError(message)
-                        msg = recvbuf.result()
-                        self.recvq.put(msg)
-                        [x(msg) for x in self.callbacks_recv]
-                        maxsize = self.options.max_msg_size
-                        recvbuf = buffers.RecvBuffer(maxsize)
+                    if self.channel:
+                        msgs = self.channel.receive(sock, self.recvbuf)
+                    else:
+                        msgs = self.recvbuf.recv(sock)
+                        self.tuning.received()
                 except BlockingIOError:
-                    pass
-
-                if self.sendq:
-                    try:
-                        self.sendq[0].send(sock)
-                        if self.sendq[0].done():
-                            self.sendq.popleft()
-                            if not self.sendq:
-                                writing = False
-                    except BlockingIOError:
-                        pass
-                    except ConnectionResetError:
-                        # The server is gone but we may have buffered messages left to
-                        # read, so we keep the socket open until recv() fails.
-                        pass
-
-            except OSError as e:
-                detail = f'{type(e).__name__}'
-                detail = f'{detail}: {e}' if str(e) else detail
-                self._log(f'Connection to server lost ({detail})')
-                self.isconn.clear()
-                isconn = False
-                poll.unregister(sock)
-                sock.close()
-                # Clear message queue on disconnect. There is no meaningful concept of
-                # sucessful delivery of a message at this level. For example, the
-                # server could receive the message but then go down immediately after,
-                # without doing anything meaningful with the message. Resending can be
-                # done based on response messages at a higher level.
-                self.sendq.clear()
-                recvbuf = buffers.RecvBuffer(maxsize=self.options.max_msg_size)
-                [x() for x in self.callbacks_disc]
-                continue
-
-        if sock:
-            sock.close()
+                    msgs = []
+                for msg in msgs:
+                    self.recvq.put(msg)
+                    [x(msg) for x in self.callbacks_recv]
+                full = self.recvq.qsize() >= self.options.max_recv_queue
+                if full and not self.paused:
+                    # Stop reading until the application catches up, so that
+                    # TCP flow control slows down the server.
+                    self.paused = time.time()
+
+            if self.sendq and self.writable:
+                if self.channel:
+                    target = self.channel.outbox
+                else:
+                    target = self.zerocopy
+                try:
+                    buffers.sendmany(target, self.sendq.schedule())
+                    self.channel and self.channel.ring(sock)
+                    self.sendq.release()
+                except BlockingIOError:
+                    self.writable = False
+                    self.channel and self.channel.ring(sock)
+                    self.sendq.release()
+                except ConnectionResetError:
+                    # The server is gone but we may have buffered messages left to
+                    # read, so we keep the socket open until recv() fails.
+                    self.writable = False
+
+        except OSError as e:
+            detail = f'{type(e).__name__}'
+            detail = f'{detail}: {e}' if str(e) else detail
+            self._log(f'Connection to server lost ({detail})')
+            self.isconn.clear()
+            if self.paused:
+                self.pausetime += time.time() - self.paused
+                self.paused = None
+            self._shutdown()
+            # Clear message queue on disconnect. There is no meaningful concept of
+            # sucessful delivery of a message at this level. For example, the
+            # server could receive the message but then go down immediately after,
+            # without doing anything meaningful with the message. Resending can be
+            # done based on response messages at a higher level.
+            self.sendq.clear()
+            [x() for x in self.callbacks_disc]
+
+    def _shutdown(self):
+        if self.sock:
+            self.reactor.watch(self, 0)
+            self.sock.close()
+            self.sock = None
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+
+    def _recvbuf(self):
+        return buffers.RecvRing(
+            self.options.max_msg_size,
+            pool=self.pool,
+            hugepages=self.options.hugepages,
+            prefault=self.options.prefault,
+        )
+
+    def _drained(self):
+        return self.recvq.qsize() <= self.options.max_recv_queue // 2
 
     def _connect(self):
-        self._log(f'Connecting to {self.addr[0]}:{self.addr[1]}')
+        self._log(f'Connecting to {addrlib.describe(self.addr)}')
         once = True
         while self.running:
-            # We need to resolve the address regularly.
-            host, port = self.addr
-            if contextlib.context.resolver:
-                host, port = contextlib.context.resolver((host, port))
-                assert isinstance(host, str), (host, port)
-            port = int(port)
-            addr = (host, port, 0, 0) if self.options.ipv6 else (host, port)
-            sock = self._create()
+            family, addr = self._resolve()
+            sock = self._create(family)
             error = None
             try:
                 sock.settimeout(10)
                 sock.connect(addr)
                 self._log('Connection established')
-                sock.sendall(self.options.handshake.encode('utf-8'))
+                self.codec = self.offer and self._negotiate(sock)
+                if self._useshm(family, addr):
+                    self.channel = self._setupshm(sock)
+                else:
+                    sock.sendall(self.options.handshake.encode('utf-8'))
                 sock.settimeout(0)
                 return sock
             except TimeoutError as e:
                 error = e
             except ConnectionError as e:
                 error = e
+            except FileNotFoundError as e:
+                error = e
             except socket.gaierror as e:
                 error = e
             if once:
@@ -227,18 +333,112 @@ class ClientSocket:
             time.sleep(self.options.connect_wait)
         return None
 
-    def _create(self):
-        if self.options.ipv6:
-            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    def _resolve(self):
+        family, addr = addrlib.resolve(self.addr, self.options.ipv6)
+        if family == socket.AF_UNIX:
+            return family, addr
+        host = addr[0]
+        if self.options.unix_upgrade and addrlib.is_local(host):
+            path = self._query(family, addr)
+            # The path may not exist when the server runs in a container that
+            # shares the network but not the file system with us.
+            if path and os.path.exists(addrlib.unix_path(path)):
+                self._log(f'Upgrading to {path}')
+                return socket.AF_UNIX, addrlib.unix_path(path)
+        return family, addr
+
+    def _query(self, family, addr):
+        # Ask the server for the Unix socket path it advertises. Servers that
+        # do not support this reject the handshake and close the connection,
+        # in which case we fall back to the original address.
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.options.connect_wait + 1)
+            sock.connect(addr)
+            query = 'unix_' + self.options.handshake
+            sock.sendall(query.encode('utf-8'))
+            response = b''
+            while True:
+                part = sock.recv(4096)
+                if not part:
+                    break
+                response += part
+        except OSError:
+            return ''
+        finally:
+            sock.close()
+        if len(response) < 8:
+            return ''
+        length = int.from_bytes(response[:8], 'little', signed=False)
+        if len(response) != 8 + length:
+            return ''
+        path = response[8:].decode('utf-8')
+        if not addrlib.is_unix(path):
+            return ''
+        return path
+
+    def _useshm(self, family, addr):
+        if not self.options.shm_ring or self.shmfailed:
+            return False
+        return family == socket.AF_UNIX or addrlib.is_local(addr[0])
+
+    def _negotiate(self, sock):
+        # Offer our codec and minimum leaf size to the server, which replies
+        # whether it supports the codec. Servers that do not know this
+        # handshake close the connection, in which case we connect again
+        # without compression.
+        if self.codecfailed:
+            return None
+        name, minsize = self.offer
+        offer = f'{name} {minsize}'.encode('utf-8')
+        query = ('codec_' + self.options.handshake).encode('utf-8')
+        try:
+            sock.sendall(query + len(offer).to_bytes(8, 'little') + offer)
+            ack = sock.recv(1)
+        except ConnectionError:
+            # The server may reset the connection because the rest of the
+            # offer is still unread when it rejects the handshake.
+            ack = b''
+        if not ack:
+            self.codecfailed = True
+            raise ConnectionError('Server does not support codecs')
+        if ack != b'\x01':
+            self._log(f'Server does not support codec {name}')
+            return None
+        return name
+
+    def _setupshm(self, sock):
+        # Create a pair of shared memory pipes and send their names to the
+        # server. Once the server acknowledges that it attached to them, we
+        # unlink the names so that the memory is freed when both sides close.
+        channel = shmpipe.Channel(self.options.shm_ring)
+        try:
+            names = ' '.join(channel.names).encode('utf-8')
+            query = ('shm_' + self.options.handshake).encode('utf-8')
+            sock.sendall(query + len(names).to_bytes(8, 'little') + names)
+            ack = sock.recv(1)
+        except Exception:
+            channel.unlink()
+            channel.close()
+            raise
+        channel.unlink()
+        if ack != b'\x01':
+            channel.close()
+            self.shmfailed = True
+            raise ConnectionError('Server does not support shared memory')
+        self._log('Using shared memory')
+        return channel
+
+    def _create(self, family):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET6:
             sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-        else:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # TODO
 
         after = self.options.keepalive_after
         every = self.options.keepalive_every
         fails = self.options.keepalive_fails
-        if after and every and fails:
+        tcp = family in (socket.AF_INET, socket.AF_INET6)
+        if tcp and after and every and fails:
             if sys.platform == 'linux':
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
                 sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, after)
@@ -262,6 +462,13 @@ class ClientSocket:
                     socket.SIO_KEEPALIVE_VALS, (1, after * 1000, every * 1000)
                 )
 
+        self.tuning = tuning.Tuning(
+            sock,
+            self.options.profile,
+            self.options.sndbuf,
+            self.options.rcvbuf,
+        )
+        self.zerocopy = zerocopy.ZeroCopy(sock, self.options.zerocopy)
         return sock
 
     def _log(self, *args):
@@ -270,3 +477,161 @@ class ClientSocket:
         contextlib.context.print(
             self.name, *args, color=self.options.logging_color
         )
+
+
+class Reactor:
+    """
+    Services the sockets of one or more clients from a single thread:
+
+    1. Connected clients register their sockets with the poll object of the
+    reactor. Other threads ask the reactor to look at a client, for example
+    after enqueuing a message, by marking it as pending and setting the
+    signal. Besides pending clients, each iteration only steps the clients
+    whose sockets are ready or that have messages left to write.
+
+    2. Connecting blocks, so a shared reactor connects its clients in
+    short-lived threads and takes over their sockets once they are connected.
+    A dedicated reactor serves a single client and connects inline.
+
+    3. A dedicated reactor exits once its client is done. Shared reactors are
+    created on demand via `Reactor.shared()` and live as long as the process.
+    """
+
+    instances = []
+    lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, count):
+        # Returns the shared reactor with the fewest clients.
+        with cls.lock:
+            while len(cls.instances) < count:
+                name = f'ClientReactor{len(cls.instances)}'
+                cls.instances.append(cls(name, dedicated=False))
+            reactors = cls.instances[:count]
+            return min(reactors, key=lambda x: len(x.clients))
+
+    def __init__(self, name, dedicated=True):
+        self.name = name
+        self.dedicated = dedicated
+        self.poll = select.poll()
+        self.signal = wakeup.Wakeup()
+        self.poll.register(self.signal, select.POLLIN)
+        self.clients = set()
+        self.sockets = {}  # {fd: ClientSocket}
+        self.pending = set()  # {ClientSocket}
+        self.busy = set()  # {ClientSocket}
+        self.blocked = set()  # {ClientSocket} waiting for space in a pipe.
+        self.retried = time.time()
+        self.incoming = collections.deque()  # [(ClientSocket, socket)]
+        self.lock = threading.Lock()
+        # Shared reactors serve clients of many threads, so they do not
+        # belong to the thread that happens to create them.
+        self.thread = thread.Thread(
+            self._loop, name=name, detached=not dedicated
+        )
+        self.dedicated or self.thread.start()
+
+    def add(self, client):
+        with self.lock:
+            self.clients.add(client)
+        self.wake(client)
+        if not self.thread.started:
+            self.thread.start()
+
+    def wake(self, client):
+        with self.lock:
+            self.pending.add(client)
+        self.signal.set()
+
+    def watch(self, client, wanted):
+        if wanted == client.events:
+            return
+        fd = client.sock.fileno()
+        if not client.events:
+            self.poll.register(fd, wanted)
+            self.sockets[fd] = client
+        elif not wanted:
+            self.poll.unregister(fd)
+            del self.sockets[fd]
+        else:
+            self.poll.modify(fd, wanted)
+        client.events = wanted
+
+    def close(self):
+        self.signal.close()
+
+    def _loop(self):
+        while not self.dedicated or self.clients:
+            timeout = 0 if self.busy else 200
+            ready = dict(self.poll.poll(timeout))
+            if ready.pop(self.signal.fileno(), 0):
+                self.signal.clear()
+            with self.lock:
+                visit, self.pending = self.pending, set()
+            while self.incoming:
+                client, sock = self.incoming.popleft()
+                client.connecting = False
+                sock and client._connected(sock)
+                visit.add(client)
+            visit |= self.busy
+            if self.blocked and time.time() - self.retried > 0.2:
+                # Notifications about free space can race with the client
+                # marking itself as waiting, so we periodically retry
+                # blocked pipes.
+                self.retried = time.time()
+                for client in self.blocked:
+                    client.writable = True
+                visit |= self.blocked
+            if not ready and not visit:
+                # Nothing happened for a while, so check on all clients.
+                visit = set(self.clients)
+            stepped = set()
+            for fd, revents in ready.items():
+                client = self.sockets.get(fd)
+                if client:
+                    client._step(revents)
+                    stepped.add(client)
+            for client in visit - stepped:
+                client._step(0)
+            for client in visit | stepped:
+                self._visit(client)
+
+    def _visit(self, client):
+        if client._done():
+            client._shutdown()
+            client.finished.set()
+            self.busy.discard(client)
+            self.blocked.discard(client)
+            with self.lock:
+                self.clients.discard(client)
+            return
+        if not client.sock and not client.connecting and client.running:
+            if client.options.autoconn or client.wantconn.is_set():
+                self._connect(client)
+        if client.sock:
+            self.watch(client, client._wanted())
+        if client._busy():
+            self.busy.add(client)
+        else:
+            self.busy.discard(client)
+        if client.channel and client.sendq and not client.writable:
+            self.blocked.add(client)
+        else:
+            self.blocked.discard(client)
+
+    def _connect(self, client):
+        client.connecting = True
+        if self.dedicated:
+            self._attach(client)
+        else:
+            name = f'{client.name}Connect'
+            thread.Thread(
+                self._attach, client, name=name, start=True, detached=True
+            )
+
+    def _attach(self, client):
+        # The socket is handed over to the reactor thread, which sets up the
+        # connection and runs the callbacks.
+        sock = client._connect()
+        self.incoming.append((client, sock))
+        self.signal.set()
@@ -0,0 +1,84 @@
+import functools
+import lzma
+import os
+import threading
+import zlib
+
+
+# Codecs are looked up by name when unpacking, so custom codecs need to be
+# registered on both the sending and the receiving side.
+CODECS = {}  # {name: (compress, decompress)}
+
+
+def register(name, compress, decompress):
+    assert isinstance(name, str) and name, name
+    assert '\x00' not in name, name
+    CODECS[name] = (compress, decompress)
+
+
+def available(name):
+    return name in CODECS
+
+
+def compress(name, buffer):
+    return CODECS[name][0](buffer)
+
+
+def decompress(name, buffer):
+    return CODECS[name][1](buffer)
+
+
+def compress_chunks(name, chunks):
+    # The stdlib codecs release the GIL, so chunks compress in parallel.
+    return _parallel(CODECS[name][0], [(x,) for x in chunks])
+
+
+def decompress_chunks(name, chunks, outputs):
+    # Each chunk is written straight into its slice of the output, so the
+    # decompressed chunks do not have to be joined afterwards.
+    fn = CODECS[name][1]
+
+    def decode(chunk, output):
+        result = fn(chunk)
+        assert len(result) == len(output), (len(result), len(output))
+        output[:] = result
+
+    _parallel(decode, list(zip(chunks, outputs)))
+
+
+def _parallel(fn, args):
+    # Short-lived daemon threads rather than a global pool, so that idle
+    # workers never block the interpreter from exiting. An error stops all
+    # workers and only the calling thread raises it, unchanged.
+    results = [None] * len(args)
+    errors = []
+    indices = iter(range(len(args)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indices, None)
+            if index is None or errors:
+                return
+            try:
+                results[index] = fn(*args[index])
+            except Exception as e:
+                errors.append(e)
+                return
+
+    workers = min(os.cpu_count() or 1, len(args))
+    threads = [
+        threading.Thread(target=worker, daemon=True)
+        for _ in range(workers - 1)
+    ]
+    [x.start() for x in threads]
+    worker()
+    [x.join() for x in threads]
+    if errors:
+        raise errors[0]
+    return results
+
+
+register('zlib', functools.partial(zlib.compress, level=1), zlib.decompress)
+register('lzma', functools.partial(lzma.compress, preset=0), lzma.decompress)
@@ -1,87 +1,366 @@
+import collections
+import itertools
 import math
+import random
 import struct
 
 import msgpack
 import numpy as np
 
+from . import codecs
 from . import sharray
 
 
-def pack(data):
+# Strided arrays are sent as their contiguous pieces if there are not too
+# many and they are not too small. Otherwise, they are copied.
+GATHER_MINSIZE = 4096
+GATHER_MAXCOUNT = 1024
+
+# Set in the buffer count of messages that reference a schema instead of
+# carrying their tree structure and leaf specs.
+SCHEMA = 1 << 63
+
+
+class UnknownSchema(Exception):
+    pass
+
+
+def pack(
+    data,
+    codec=None,
+    minsize=64 * 1024,
+    chunksize=4 * 1024**2,
+    inline_size=256,
+):
+    # Leaves of up to the inline size are stored together in a single
+    # msgpack buffer, so that only larger leaves need buffers of their own.
+    # Bytes and array leaves of at least the minimum size are compressed with
+    # the codec, unless that does not make them smaller. The codec is noted
+    # in the spec of each compressed leaf. Array leaves larger than the chunk
+    # size are compressed as independent chunks in parallel, and the spec
+    # additionally holds the chunk size and the compressed chunk lengths.
+    treedef, specs, values, buffers = _encode(
+        data, codec, minsize, chunksize, inline_size
+    )
+    header = [msgpack.packb(treedef), msgpack.packb(specs)]
+    return _frame([*header, msgpack.packb(values), *buffers])
+
+
+def unpack(buffer, schemas=None):
+    length = int.from_bytes(buffer[:8], 'little', signed=False)
+    buffer = buffer[8:]
+    flags, length = length & SCHEMA, length & ~SCHEMA
+    sizes = struct.unpack('<' + ('Q' * length), buffer[: 8 * length])
+    buffer = buffer[8 * length :]
+    limits = np.cumsum(sizes)
+    buffers = [buffer[i:j] for i, j in zip([0, *limits[:-1]], limits)]
+    if flags:
+        if schemas is None:
+            raise UnknownSchema('Received a schema without a schema cache')
+        header, values, *buffers = buffers
+        return schemas.lookup(header).unpack(values, buffers)
+    treedef, specs, values, *buffers = buffers
+    treedef = msgpack.unpackb(treedef)
+    specs = msgpack.unpackb(specs)
+    kind, values = type(values), iter(msgpack.unpackb(values))
+    buffers = iter(buffers)
+    leaves = [_decode(spec, values, buffers, kind) for spec in specs]
+    data = tree_unflatten(leaves, treedef)
+    return data
+
+
+class Schemas:
+    """
+    Sender side of the schema cache. Messages with the same tree structure and
+    leaf specs, which include dtypes and shapes, are assigned an id:
+
+    1. The first messages of a structure carry the full schema together with
+    its id, which the receiver stores in its `SchemaCache`.
+
+    2. Once the receiver confirmed a schema, for example by responding to a
+    request that defined it, later messages only carry the id.
+
+    3. Ids are scoped to a random session that is replaced on reset(), for
+    example after reconnecting, because the receiver may have lost its cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.reset()
+
+    def reset(self):
+        self.session = random.getrandbits(62)
+        self.ids = {}  # {key: id}
+        self.confirmed = set()  # {id}
+        self.counter = itertools.count()
+
+    def pack(
+        self,
+        data,
+        codec=None,
+        minsize=64 * 1024,
+        chunksize=4 * 1024**2,
+        inline_size=256,
+    ):
+        # Returns the message and the schema that it defines, if any, which
+        # should be passed to confirm() once the receiver has processed it.
+        treedef, specs, values, buffers = _encode(
+            data, codec, minsize, chunksize, inline_size
+        )
+        buffers = [msgpack.packb(values), *buffers]
+        # The compressed chunk lengths differ between messages.
+        chunked = any(len(x) > 4 for x in specs if x[0] in ('array', 'farray'))
+        session, ids, confirmed = self.session, self.ids, self.confirmed
+        key = msgpack.packb([treedef, specs])
+        ident = ids.get(key)
+        if ident is None and not chunked and len(ids) < self.maxsize:
+            ident = ids.setdefault(key, next(self.counter))
+        if ident is None:
+            header = [msgpack.packb(treedef), msgpack.packb(specs)]
+            return _frame([*header, *buffers]), None
+        if ident in confirmed:
+            header = msgpack.packb([session, ident])
+            return _frame([header, *buffers], SCHEMA), None
+        header = msgpack.packb([session, ident, treedef, specs])
+        return _frame([header, *buffers], SCHEMA), (session, ident)
+
+    def confirm(self, schema):
+        session, ident = schema
+        if session == self.session:
+            self.confirmed.add(ident)
+
+
+class SchemaCache:
+    """
+    Receiver side of the schema cache, which keeps the most recently used
+    schemas of all senders together with their unflatten plans.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.schemas = collections.OrderedDict()  # {header: Schema}
+
+    def lookup(self, header):
+        schema = self.schemas.get(bytes(header))
+        if schema:
+            self.schemas.move_to_end(bytes(header))
+            return schema
+        header = msgpack.unpackb(header)
+        if len(header) == 2:
+            raise UnknownSchema(f'Unknown schema {header}')
+        session, ident, treedef, specs = header
+        schema = Schema(treedef, specs)
+        self.schemas[msgpack.packb([session, ident])] = schema
+        while len(self.schemas) > self.maxsize:
+            self.schemas.popitem(last=False)
+        return schema
+
+
+class Schema:
+    def __init__(self, treedef, specs):
+        self.treedef = treedef
+        self.specs = specs
+        self.unflatten = _unflattener(treedef)
+
+    def unpack(self, values, buffers):
+        kind, values = type(values), iter(msgpack.unpackb(values))
+        buffers = iter(buffers)
+        leaves = [_decode(spec, values, buffers, kind) for spec in self.specs]
+        return self.unflatten(iter(leaves))
+
+
+def _encode(data, codec, minsize, chunksize, inline_size):
+    # Returns the specs of all leaves, the values of inlined leaves, and the
+    # buffers of the remaining leaves. None and shared arrays are described
+    # by their spec alone.
+    assert 0 <= inline_size, inline_size
     leaves, treedef = tree_flatten(data)
-    specs, buffers = [], []
+    specs, values, buffers = [], [], []
     for value in leaves:
         if value is None:
             specs.append(['none'])
-            buffers.append(b'\x00')
         elif isinstance(value, str):
-            specs.append(['utf8'])
-            buffers.append(value.encode('utf-8'))
+            if len(value) <= inline_size:
+                specs.append(['utf8', 'inline'])
+                values.append(value)
+            else:
+                specs.append(['utf8'])
+                buffers.append(value.encode('utf-8'))
         elif isinstance(value, (bytes, bytearray, memoryview)):
             if isinstance(value, memoryview):
                 value = value.cast('c')
                 assert value.c_contiguous
+            if len(value) <= inline_size:
+                specs.append(['bytes', 'inline'])
+                values.append(bytes(value))
+                continue
             specs.append(['bytes'])
-            buffers.append(value)
+            buffers.append(_compress(value, specs[-1], codec, minsize))
         elif isinstance(value, (np.ndarray, np.generic, int, float)):
             value = np.asarray(value)
             if value.dtype == object:
                 raise TypeError(data)
-            assert value.data.c_contiguous, (
-                'Array is not contiguous in memory. Use '
-                + "np.asarray(arr, order='C') before passing the data into pack()."
+            if value.nbytes <= inline_size:
+                specs.append(['array', value.shape, value.dtype.str, 'inline'])
+                values.append(value.tobytes())
+                continue
+            kind = 'array'
+            if not value.data.c_contiguous and value.data.f_contiguous:
+                # Fortran-order arrays are sent as their C-order transpose
+                # and transposed back by the receiver.
+                kind, value = 'farray', value.T
+            specs.append([kind, value.shape, value.dtype.str])
+            if kind == 'farray':
+                specs[-1][1] = value.shape[::-1]
+            if value.data.c_contiguous:
+                buffer = value.data.cast('c')
+            elif codec and value.nbytes >= minsize:
+                buffer = np.ascontiguousarray(value).data.cast('c')
+            else:
+                buffers.append(_gather(value))
+                continue
+            buffers.append(
+                _compress(buffer, specs[-1], codec, minsize, chunksize)
             )
-            specs.append(['array', value.shape, value.dtype.str])
-            buffer = value.data.cast('c') if value.size else b'\x00'
-            buffers.append(buffer)
         elif isinstance(value, sharray.SharedArray):
             specs.append(['sharray', *value.__getstate__()])
-            buffers.append(b'\x00')
         else:
             raise NotImplementedError(type(value))
-    buffers = [msgpack.packb(treedef), msgpack.packb(specs), *buffers]
-    length = len(buffers).to_bytes(8, 'little', signed=False)
-    sizes = struct.pack('<' + ('Q' * len(buffers)), *[len(x) for x in buffers])
-    buffers = [length, sizes, *buffers]
-    return buffers
+    return treedef, specs, values, buffers
 
 
-def unpack(buffer):
-    length = int.from_bytes(buffer[:8], 'little', signed=False)
-    buffer = buffer[8:]
-    sizes = struct.unpack('<' + ('Q' * length), buffer[: 8 * length])
-    buffer = buffer[8 * length :]
-    limits = np.cumsum(sizes)
-    buffers = [buffer[i:j] for i, j in zip([0, *limits[:-1]], limits)]
-    treedef, specs, *buffers = buffers
-    treedef = msgpack.unpackb(treedef)
-    specs = msgpack.unpackb(specs)
-    leaves = []
-    for spec, buffer in zip(specs, buffers):
-        if spec[0] == 'none':
-            assert buffer == b'\x00'
-            leaves.append(None)
-        elif spec[0] == 'utf8':
-            leaves.append(bytes(buffer).decode('utf-8'))
-        elif spec[0] == 'bytes':
-            leaves.append(buffer)
-        elif spec[0] == 'array':
-            shape, dtype = spec[1:]
-            if not math.prod(shape):
-                assert buffer == b'\x00'
-                buffer = b''
-            leaves.append(np.frombuffer(buffer, dtype).reshape(shape))
-        elif spec[0] == 'sharray':
-            assert buffer == b'\x00'
-            leaves.append(sharray.SharedArray(*spec[1:]))
+def _gather(array):
+    # Returns the contiguous pieces of a strided array in C order, which the
+    # socket sends with a single writev() call. Arrays with too many or too
+    # small pieces are copied instead.
+    ndim, size = array.ndim, array.itemsize
+    while ndim and (
+        array.shape[ndim - 1] == 1 or array.strides[ndim - 1] == size
+    ):
+        size *= array.shape[ndim - 1]
+        ndim -= 1
+    count = math.prod(array.shape[:ndim])
+    if size < GATHER_MINSIZE or count > GATHER_MAXCOUNT:
+        return np.ascontiguousarray(array).data.cast('c')
+    return [array[x].data.cast('c') for x in np.ndindex(array.shape[:ndim])]
+
+
+def _frame(buffers, flags=0):
+    # Gathered leaves consist of multiple pieces that are sent back to back,
+    # so the receiver sees a single contiguous buffer.
+    sizes, pieces = [], []
+    for buffer in buffers:
+        if isinstance(buffer, list):
+            sizes.append(sum(len(x) for x in buffer))
+            pieces += buffer
         else:
-            raise NotImplementedError(spec)
-    data = tree_unflatten(leaves, treedef)
-    return data
+            sizes.append(len(buffer))
+            pieces.append(buffer)
+    length = (len(buffers) | flags).to_bytes(8, 'little', signed=False)
+    sizes = struct.pack('<' + ('Q' * len(sizes)), *sizes)
+    return [length, sizes, *pieces]
+
+
+def _decode(spec, values, buffers, kind):
+    if spec[0] == 'none':
+        return None
+    elif spec[0] == 'utf8':
+        if len(spec) > 1:
+            return next(values)
+        return bytes(next(buffers)).decode('utf-8')
+    elif spec[0] == 'bytes':
+        # Bytes leaves are slices of the message, so inlined and compressed
+        # ones are converted to the same type, usually a memoryview.
+        if spec[1:] == ['inline']:
+            return kind(next(values))
+        buffer = next(buffers)
+        if len(spec) > 1:
+            return kind(codecs.decompress(spec[1], buffer))
+        return buffer
+    elif spec[0] == 'array':
+        shape, dtype = spec[1:3]
+        if spec[3:] == ['inline']:
+            # Copy into a bytearray so that the array is writable like
+            # arrays that view into the received message.
+            buffer = bytearray(next(values))
+            return np.frombuffer(buffer, dtype).reshape(shape)
+        if len(spec) > 3:
+            return _decompress(next(buffers), *spec[1:])
+        return np.frombuffer(next(buffers), dtype).reshape(shape)
+    elif spec[0] == 'farray':
+        # Copy the transposed array to give the receiver a C-order array.
+        spec = ['array', spec[1][::-1], *spec[2:]]
+        array = _decode(spec, values, buffers, kind)
+        return np.ascontiguousarray(array.T)
+    elif spec[0] == 'sharray':
+        return sharray.SharedArray(*spec[1:])
+    else:
+        raise NotImplementedError(spec)
+
+
+def _unflattener(structure):
+    # Builds a function that rebuilds the structure from an iterator over the
+    # leaves, like tree_unflatten() without inspecting the structure again.
+    if isinstance(structure, list):
+        if all(x is None for x in structure):
+            size = len(structure)
+            return lambda leaves: list(itertools.islice(leaves, size))
+        fns = [_unflattener(x) for x in structure]
+        return lambda leaves: [fn(leaves) for fn in fns]
+    if isinstance(structure, dict):
+        if all(x is None for x in structure.values()):
+            keys = list(structure.keys())
+            return lambda leaves: dict(zip(keys, leaves))
+        items = [(k, _unflattener(v)) for k, v in structure.items()]
+        return lambda leaves: {k: fn(leaves) for k, fn in items}
+    assert structure is None, structure
+    return next
+
+
+def _compress(buffer, spec, codec, minsize, chunksize=None):
+    if not codec or len(buffer) < minsize:
+        return buffer
+    if not chunksize or len(buffer) <= chunksize:
+        compressed = codecs.compress(codec, buffer)
+        if len(compressed) >= len(buffer):
+            return buffer
+        spec.append(codec)
+        return compressed
+    chunks = [
+        buffer[i : i + chunksize] for i in range(0, len(buffer), chunksize)
+    ]
+    chunks = codecs.compress_chunks(codec, chunks)
+    lengths = [len(x) for x in chunks]
+    if sum(lengths) >= len(buffer):
+        return buffer
+    spec.extend([codec, chunksize, lengths])
+    return b''.join(chunks)
+
+
+def _decompress(buffer, shape, dtype, codec, chunksize=None, lengths=None):
+    # Decompress into a new array rather than viewing into the decompressed
+    # bytes, so that the array is writable like arrays that view into the
+    # received message.
+    dtype = np.dtype(dtype)
+    output = np.empty(math.prod(shape) * dtype.itemsize, np.uint8)
+    array = output.view(dtype).reshape(shape)
+    output = memoryview(output)
+    if not chunksize:
+        codecs.decompress_chunks(codec, [buffer], [output])
+        return array
+    starts = [0, *itertools.accumulate(lengths)]
+    chunks = [buffer[i:j] for i, j in zip(starts[:-1], starts[1:])]
+    outputs = [
+        output[i : i + chunksize] for i in range(0, len(output), chunksize)
+    ]
+    codecs.decompress_chunks(codec, chunks, outputs)
+    return array
 
 
 def tree_map(fn, *trees, isleaf=None):
     assert trees, 'Provide one or more nested Python structures'
+    if len(trees) == 1:
+        return _walk(trees[0], fn, isleaf)
     kw = dict(isleaf=isleaf)
     first = trees[0]
     try:
@@ -117,14 +396,71 @@ def tree_map(fn, *trees, isleaf=None):
 
 def tree_flatten(tree, isleaf=None):
     leaves = []
-    tree_map(lambda x: leaves.append(x), tree, isleaf=isleaf)
-    structure = tree_map(lambda x: None, tree, isleaf=isleaf)
+    structure = _walk(tree, leaves.append, isleaf)
     return tuple(leaves), structure
 
 
 def tree_unflatten(leaves, structure):
     leaves = iter(tuple(leaves))
-    return tree_map(lambda x: next(leaves), structure)
+    return _walk(structure, lambda x: next(leaves))
+
+
+# Container kinds by type, filled in on first use of each type.
+KINDS = {list: 'list', tuple: 'tuple', dict: 'dict'}
+
+
+def _walk(tree, fn, isleaf=None):
+    # Maps the leaves of a tree in a single non-recursive pass, with the same
+    # container rules as tree_map(). Each stack entry holds a container that
+    # is being visited, which is rebuilt once all its children are done.
+    kinds = KINDS
+    root = []
+    stack = [('list', None, None, iter((tree,)), root)]
+    while stack:
+        kind, node, keys, children, built = stack[-1]
+        for child in children:
+            if isleaf and isleaf(child):
+                built.append(fn(child))
+                continue
+            cls = type(child)
+            childkind = kinds.get(cls)
+            if childkind is None:
+                childkind = _kind(cls)
+            if not childkind:
+                built.append(fn(child))
+            elif childkind in ('list', 'tuple'):
+                stack.append((childkind, child, None, iter(child), []))
+                break
+            else:
+                childkeys = list(child)
+                values = [child[k] for k in childkeys]
+                stack.append((childkind, child, childkeys, iter(values), []))
+                break
+        else:
+            stack.pop()
+            if kind == 'tuple':
+                built = tuple(built)
+            elif kind == 'dict':
+                built = dict(zip(keys, built))
+            elif kind == 'mapping':
+                built = type(node)(dict(zip(keys, built)))
+            stack and stack[-1][4].append(built)
+    return root[0]
+
+
+def _kind(cls):
+    if issubclass(cls, list):
+        kind = 'list'
+    elif issubclass(cls, tuple):
+        kind = 'tuple'
+    elif issubclass(cls, dict):
+        kind = 'dict'
+    elif hasattr(cls, 'keys') and hasattr(cls, 'get'):
+        kind = 'mapping'
+    else:
+        kind = ''
+    KINDS[cls] = kind
+    return kind
 
 
 def tree_equals(xs, ys):
@@ -1,5 +1,8 @@
+import asyncio
 import concurrent.futures
 
+from . import thread
+
 
 class ThreadPool:
     def __init__(self, workers, name):
@@ -14,3 +17,34 @@ class ThreadPool:
 
     def close(self, wait=False):
         self.pool.shutdown(wait=wait)
+
+
+class AsyncPool:
+    def __init__(self, name):
+        # Coroutines of all async methods run concurrently on one event loop
+        # in a background thread, so many requests can wait on I/O without a
+        # thread each.
+        self.loop = asyncio.new_event_loop()
+        self.thread = thread.Thread(self._run, name=name, start=True)
+
+    def submit(self, fn, *args, **kwargs):
+        coro = fn(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self, wait=False):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=None if wait else 1)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            # Cancel requests that are still running when the server closes.
+            tasks = asyncio.all_tasks(self.loop)
+            [task.cancel() for task in tasks]
+            gather = asyncio.gather(*tasks, return_exceptions=True)
+            self.loop.run_until_complete(gather)
+        finally:
+            self.loop.close()
@@ -1,5 +1,6 @@
 import collections
-import concurrent.futures
+import inspect
+import threading
 import time
 import types
 
@@ -14,7 +15,11 @@ class Server:
         self.socket = server_socket.ServerSocket(port, name, **kwargs)
         self.loop = thread.Thread(self._loop, name=f'{name}Loop')
         self.methods = {}
+        self.schemas = packlib.SchemaCache()
         self.jobs = set()
+        self.finished = collections.deque()
+        self.wakeup = threading.Event()
+        self.asyncpool = None
         self.workers = workers
         self.errors = errors
         self.running = False
@@ -28,13 +33,22 @@ class Server:
     def bind(self, name, workfn, postfn=None, workers=0):
         assert not self.running
         assert name not in self.methods, name
-        if workers:
+        if inspect.iscoroutinefunction(workfn):
+            # Async methods share one event loop. The number of workers
+            # limits how many requests of the method run concurrently.
+            if not self.asyncpool:
+                self.asyncpool = poollib.AsyncPool(f'{self.socket.name}Async')
+                self.pools.append(self.asyncpool)
+            pool = self.asyncpool
+            available = workers or 1024
+        elif workers:
             pool = poollib.ThreadPool(workers, '{name}_pool')
             self.pools.append(pool)
+            available = workers + 1
         else:
             pool = self.pool
+            available = self.workers + 1
         requests = collections.deque()
-        available = (workers or self.workers) + 1
         self.methods[name] = types.SimpleNamespace(
             workfn=workfn,
             postfn=postfn,
@@ -65,6 +79,7 @@ class Server:
         mets = self.metrics
         self.metrics = dict(send=0, recv=0, time=now)
         dur = now - mets['time']
+        sockstats = self.socket.stats()
         stats = {
             'numsend': mets['send'],
             'numrecv': mets['recv'],
@@ -72,6 +87,8 @@ class Server:
             'recvrate': mets['recv'] / dur,
             'requests': sum(len(m.requests) for m in self.methods.values()),
             'jobs': len(self.jobs),
+            'numpaused': sockstats['numpaused'],
+            'pausetime': sum(sockstats['pausetime'].values()),
         }
         if any(method.postfn for method in self.methods.values()):
             update = {
@@ -106,7 +123,12 @@ class Server:
                 try:
                     strlen = int.from_bytes(data[:8], 'little', signed=False)
                     name = bytes(data[8 : 8 + strlen]).decode('utf-8')
-                    data = packlib.unpack(data[8 + strlen :])
+                    data = packlib.unpack(data[8 + strlen :], self.schemas)
+                except packlib.UnknownSchema:
+                    # The client sends the request again with its structure.
+                    status = int(7).to_bytes(8, 'little', signed=False)
+                    self.socket.send(addr, reqnum, status, b'Unknown schema')
+                    break
                 except Exception:
                     self._error(addr, reqnum, 2, 'Could not decode message')
                     break
@@ -128,18 +150,19 @@ class Server:
                     job.addr = addr
                     job.reqnum = reqnum
                     self.jobs.add(job)
+                    job.add_done_callback(self._finish)
                     if method.postfn:
                         self.postfn_inp.append(job)
 
-            completed, self.jobs = concurrent.futures.wait(
-                self.jobs, 0.0001, concurrent.futures.FIRST_COMPLETED
-            )
-            for job in completed:
+            for job in self._completed(timeout=0.0001):
                 try:
                     data = job.result()
                     if job.method.postfn:
                         data, _ = data
-                    data = packlib.pack(data)
+                    # Compressed with the codec that the client negotiated
+                    # when it connected, if any.
+                    codec = self.socket.codec(job.addr)
+                    data = packlib.pack(data, *codec)
                     status = int(0).to_bytes(8, 'little', signed=False)
                     self.socket.send(job.addr, job.reqnum, status, *data)
                     self.metrics['send'] += 1
@@ -151,7 +174,7 @@ class Server:
                         job.method.available += 1
                         pending -= 1
 
-            if completed:
+            if self.postfn_inp:
                 # Call postfns in the order the requests were received.
                 while self.postfn_inp and self.postfn_inp[0].done():
                     job = self.postfn_inp.popleft()
@@ -166,6 +189,23 @@ class Server:
                 postjob.method.available += 1
                 pending -= 1
 
+    def _finish(self, job):
+        self.finished.append(job)
+        self.wakeup.set()
+
+    def _completed(self, timeout):
+        # Jobs report completion through a callback, so that waiting does not
+        # take time proportional to the number of running jobs.
+        if not self.finished:
+            self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        completed = []
+        while self.finished:
+            job = self.finished.popleft()
+            self.jobs.discard(job)
+            completed.append(job)
+        return completed
+
     def _error(self, addr, reqnum, status, message):
         status = status.to_bytes(8, 'little', signed=False)
         data = message.encode('utf-8')
@@ -1,13 +1,22 @@
 import collections
 import dataclasses
+import itertools
 import os
 import queue
 import selectors
 import socket
+import threading
+import time
 
+from . import addrlib
 from . import buffers
+from . import codecs
 from . import contextlib
+from . import shmpipe
 from . import thread
+from . import tuning
+from . import wakeup
+from . import zerocopy
 
 
 class Connection:
@@ -16,12 +25,45 @@ class Connection:
         self.addr = addr
         self.recvbuf = None
         self.handshake = b''
-        self.sendbufs = collections.deque()
+        self.ready = False
+        self.shm = None
+        self.shmsetup = False
+        self.codec = (None, 0)  # Codec and minimum leaf size for responses.
+        self.codecsetup = False
+        self.sendbufs = None
+        self.writing = False
+        self.paused = None  # Time at which reading was paused.
+        self.pausetime = 0.0  # Total seconds that reading was paused.
+        self.events = selectors.EVENT_READ
+        self.reactor = None
+        self.tuning = None
+        self.zerocopy = None
 
     def fileno(self):
         return self.sock.fileno()
 
 
+class Reactor:
+    def __init__(self, name):
+        self.name = name
+        self.sel = selectors.DefaultSelector()
+        self.signal = wakeup.Wakeup()
+        self.sel.register(self.signal, selectors.EVENT_READ, data='signal')
+        self.incoming = collections.deque()  # [Connection]
+        self.pending = collections.deque()  # [Connection]
+        self.blocked = set()  # {Connection}
+        self.paused = set()  # {Connection}
+        self.retried = time.time()
+        self.thread = None
+
+    def wake(self):
+        self.signal.set()
+
+    def close(self):
+        self.sel.close()
+        self.signal.close()
+
+
 @dataclasses.dataclass
 class Options:
     ipv6: bool = False
@@ -32,55 +74,119 @@ class Options:
     logging: bool = True
     logging_color: str = 'blue'
     handshake: str = 'portal_handshake'
+    reactors: int = 1
+    profile: str = 'auto'
+    sndbuf: int = 0
+    rcvbuf: int = 0
+    unix_path: str = ''
+    frame_size: int = 1024**2
+    zerocopy: int = 0
+    pool_size: int = 256 * 1024**2
+    hugepages: int = 0
+    prefault: bool = False
 
 
 class ServerSocket:
     def __init__(self, port, name='Server', **kwargs):
-        if isinstance(port, str):
-            assert '://' not in port, port
-            port = int(port.rsplit(':', 1)[-1])
         self.name = name
         self.options = Options(**{**contextlib.context.serverkw, **kwargs})
         self.handshake = self.options.handshake.encode('utf-8')
-        if self.options.ipv6:
-            self.sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-            self.addr = (self.options.host or '::', port, 0, 0)
+        # Clients on the same machine can ask for the advertised Unix socket
+        # path by sending this handshake instead of the regular one.
+        self.query = b'unix_' + self.handshake
+        # Clients on the same machine can ask to exchange messages through
+        # shared memory by sending this handshake followed by the names of the
+        # shared memory pipes.
+        self.shmquery = b'shm_' + self.handshake
+        # Clients can ask for compressed responses by sending this handshake
+        # followed by the codec name and minimum leaf size, before one of the
+        # handshakes above.
+        self.codecquery = b'codec_' + self.handshake
+        if addrlib.is_unix(port):
+            self.addr = port
+            self._log(f'Binding to {self.addr}')
+            self.sock = addrlib.listen_unix(addrlib.unix_path(port))
         else:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.addr = (self.options.host or '0.0.0.0', port)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # TODO
-        self._log(f'Binding to {self.addr[0]}:{self.addr[1]}')
-        self.sock.bind(self.addr)
+            if isinstance(port, str):
+                assert '://' not in port, port
+                port = int(port.rsplit(':', 1)[-1])
+            if self.options.ipv6:
+                self.sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+                self.sock.setsockopt(
+                    socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1
+                )
+                self.addr = (self.options.host or '::', port, 0, 0)
+            else:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.addr = (self.options.host or '0.0.0.0', port)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._log(f'Binding to {addrlib.describe(self.addr)}')
+            self.sock.bind(self.addr)
         self.sock.setblocking(False)
         self.sock.listen(8192)
-        self.get_signal, self.set_signal = os.pipe()
-        self.sel = selectors.DefaultSelector()
-        self.sel.register(self.get_signal, selectors.EVENT_READ, data='signal')
-        self.sel.register(self.sock, selectors.EVENT_READ, data=None)
-        self._log(f'Listening at {self.addr[0]}:{self.addr[1]}')
+        self.listeners = [self.sock]
+        if self.options.unix_path:
+            path = self.options.unix_path
+            self._log(f'Binding to {addrlib.UNIX}{path}')
+            unixsock = addrlib.listen_unix(path)
+            unixsock.setblocking(False)
+            unixsock.listen(8192)
+            self.listeners.append(unixsock)
+        self.unixids = itertools.count()
+        # Connections are spread across one or more reactors that each run
+        # their own selector loop in a separate thread. The first reactor also
+        # accepts new connections and hands them off to the others.
+        assert 1 <= self.options.reactors, self.options.reactors
+        self.reactors = [
+            Reactor(f'{name}Loop' + (str(i) if i else ''))
+            for i in range(self.options.reactors)
+        ]
+        for listener in self.listeners:
+            self.reactors[0].sel.register(
+                listener, selectors.EVENT_READ, data=None
+            )
+        self._log(f'Listening at {addrlib.describe(self.addr)}')
         self.conns = {}
+        self.pool = None
+        if self.options.pool_size:
+            self.pool = buffers.BufferPool.shared(self.options.pool_size)
+        # Clients can stripe large messages over several connections.
+        self.stripes = buffers.Stripes()
         self.recvq = queue.Queue()  # [(addr, bytes)]
+        self.numaccepted = 0
+        self.numqueued = 0
+        self.numsent = 0
+        self.lock = threading.Lock()
         self.reading = True
         self.running = True
         self.error = None
-        self.thread = thread.Thread(self._loop, name=f'{name}Loop', start=True)
+        for reactor in self.reactors:
+            reactor.thread = thread.Thread(
+                self._loop, reactor, name=reactor.name, start=True
+            )
 
     @property
     def connections(self):
         return tuple(self.conns.keys())
 
+    def codec(self, addr):
+        # Codec and minimum leaf size that the client negotiated for responses.
+        conn = self.conns.get(addr)
+        return conn.codec if conn else (None, 0)
+
     def recv(self, timeout=None):
         if self.error:
             raise self.error
         assert self.running
         try:
-            return self.recvq.get(block=(timeout != 0), timeout=timeout)
+            result = self.recvq.get(block=(timeout != 0), timeout=timeout)
         except queue.Empty:
             raise TimeoutError
+        if self.recvq.qsize() <= self.options.max_recv_queue // 2:
+            [r.wake() for r in self.reactors if r.paused]
+        return result
 
-    def send(self, addr, *data):
+    def send(self, addr, *data, priority=0):
         if self.error:
             raise self.error
         assert self.running
@@ -88,112 +194,348 @@ class ServerSocket:
             raise RuntimeError('Too many outgoing messages enqueued')
         maxsize = self.options.max_msg_size
         try:
-            buf = buffers.SendBuffer(*data, maxsize=maxsize)
-            self.conns[addr].sendbufs.append(buf)
-            os.write(self.set_signal, bytes(1))
+            conn = self.conns[addr]
         except KeyError:
             self._log('Dropping message to disconnected client')
+            return
+        with self.lock:
+            self.numqueued += 1
+        buf = buffers.SendBuffer(*data, maxsize=maxsize)
+        conn.tuning.sent(buf.length)
+        conn.sendbufs.append(buf, priority)
+        conn.reactor.pending.append(conn)
+        conn.reactor.wake()
+
+    def stats(self):
+        now = time.time()
+        conns = list(self.conns.values())
+        return {
+            'numpaused': sum(1 for conn in conns if conn.paused),
+            'pausetime': {
+                conn.addr: conn.pausetime
+                + (now - conn.paused if conn.paused else 0)
+                for conn in conns
+            },
+        }
 
     def shutdown(self):
         self.reading = False
 
     def close(self, timeout=None):
         self.running = False
-        self.thread.join(timeout)
-        [conn.sock.close() for conn in self.conns.values()]
-        self.sock.close()
-        self.sel.close()
-        os.close(self.get_signal)
-        os.close(self.set_signal)
+        [reactor.thread.join(timeout) for reactor in self.reactors]
+        [conn.sock.close() for conn in list(self.conns.values())]
+        [conn.sock.close() for r in self.reactors for conn in r.incoming]
+        for listener in self.listeners:
+            if listener.family == socket.AF_UNIX:
+                path = listener.getsockname()
+                listener.close()
+                os.path.exists(path) and os.unlink(path)
+            else:
+                listener.close()
+        [reactor.close() for reactor in self.reactors]
 
-    def _loop(self):
-        writing = False
+    def _loop(self, reactor):
         try:
             while self.running or self._numsending():
-                for key, mask in self.sel.select(timeout=0.2):
+                for key, mask in reactor.sel.select(timeout=0.2):
                     if key.data == 'signal':
-                        writing = True
-                        os.read(self.get_signal, 1)
-                    elif key.data is None and self.reading:
-                        assert mask & selectors.EVENT_READ
-                        self._accept(key.fileobj)
-                    elif mask & selectors.EVENT_READ and self.reading:
-                        self._recv(key.data)
-                if not writing:
-                    continue
-                pending = [
-                    conn for conn in self.conns.values() if conn.sendbufs
-                ]
-                for conn in pending:
-                    try:
-                        conn.sendbufs[0].send(conn.sock)
-                        if conn.sendbufs[0].done():
-                            conn.sendbufs.popleft()
-                            if not any(conn.sendbufs for conn in pending):
-                                writing = False
-                    except BlockingIOError:
-                        pass
-                    except ConnectionResetError:
-                        # The client is gone but we may have buffered messages left
-                        # to read, so we keep the socket open until recv() fails.
-                        pass
+                        reactor.signal.clear()
+                        self._register(reactor)
+                        self._flush(reactor)
+                    elif key.data is None:
+                        if self.reading:
+                            assert mask & selectors.EVENT_READ
+                            self._accept(key.fileobj)
+                    else:
+                        conn = key.data
+                        if mask & selectors.EVENT_READ and self.reading:
+                            self._recv(conn)
+                        if mask & selectors.EVENT_WRITE and self._alive(conn):
+                            self._send(conn)
+                if reactor.blocked and time.time() - reactor.retried > 0.2:
+                    self._retry(reactor)
+                if reactor.paused:
+                    self._resume(reactor)
         except Exception as e:
             self.error = e
 
-    def _accept(self, sock):
-        sock, addr = sock.accept()
-        self._log(f'Accepted connection from {addr[0]}:{addr[1]}')
+    def _register(self, reactor):
+        while reactor.incoming:
+            conn = reactor.incoming.popleft()
+            reactor.sel.register(conn.sock, selectors.EVENT_READ, data=conn)
+            self.conns[conn.addr] = conn
+
+    def _flush(self, reactor):
+        # Try to send newly enqueued messages right away. Connections whose
+        # socket buffer is full are registered for write events and continue
+        # once the socket becomes writable again, so idle connections cost
+        # nothing per wakeup.
+        while reactor.pending:
+            conn = reactor.pending.popleft()
+            if not self._alive(conn):
+                self._drop(conn)
+            elif not conn.writing:
+                self._send(conn)
+
+    def _send(self, conn):
+        conn.zerocopy.inflight and conn.zerocopy.reap()
+        target = conn.shm.outbox if conn.shm else conn.zerocopy
+        written = 0
+        try:
+            while conn.sendbufs:
+                frames = conn.sendbufs.schedule()
+                size, total = buffers.sendmany(target, frames)
+                written += size
+                count = conn.sendbufs.release()
+                with self.lock:
+                    self.numsent += count
+                if size < total:
+                    break  # The socket buffer is full.
+        except BlockingIOError:
+            pass
+        except ConnectionResetError as e:
+            # The client is gone but we may have buffered messages left to
+            # read, so we keep the socket open until recv() fails. Once we
+            # stopped reading, there is nothing left to wait for.
+            if not self.reading:
+                self._disconnect(conn, e)
+                return
+            self._interest(conn, False)
+            return
+        if conn.shm:
+            # The peer notifies us through the socket when it frees up space
+            # in the pipe, so we do not wait for write events.
+            written and conn.shm.ring(conn.sock)
+            if conn.sendbufs:
+                conn.reactor.blocked.add(conn)
+            else:
+                conn.reactor.blocked.discard(conn)
+            return
+        self._interest(conn, bool(conn.sendbufs))
+
+    def _retry(self, reactor):
+        # Notifications about free space can race with the writer marking
+        # itself as waiting, so we periodically retry blocked pipes.
+        reactor.retried = time.time()
+        for conn in list(reactor.blocked):
+            if self._alive(conn):
+                self._send(conn)
+            else:
+                reactor.blocked.discard(conn)
+
+    def _interest(self, conn, writing):
+        if conn.writing == writing:
+            return
+        conn.writing = writing
+        self._update(conn)
+
+    def _pause(self, conn):
+        # Stop reading from the connection until the application catches up
+        # with the receive queue. The kernel buffers fill up and TCP flow
+        # control slows down the sender.
+        conn.paused = time.time()
+        conn.reactor.paused.add(conn)
+        self._update(conn)
+
+    def _resume(self, reactor):
+        if self.recvq.qsize() > self.options.max_recv_queue // 2:
+            return
+        now = time.time()
+        for conn in list(reactor.paused):
+            reactor.paused.discard(conn)
+            conn.pausetime += now - conn.paused
+            conn.paused = None
+            self._alive(conn) and self._update(conn)
+
+    def _update(self, conn):
+        events = 0 if conn.paused else selectors.EVENT_READ
+        events |= selectors.EVENT_WRITE if conn.writing else 0
+        if events == conn.events:
+            return
+        sel = conn.reactor.sel
+        if not conn.events:
+            sel.register(conn.sock, events, data=conn)
+        elif not events:
+            sel.unregister(conn.sock)
+        else:
+            sel.modify(conn.sock, events, data=conn)
+        conn.events = events
+
+    def _recvbuf(self):
+        return buffers.RecvRing(
+            self.options.max_msg_size,
+            pool=self.pool,
+            hugepages=self.options.hugepages,
+            prefault=self.options.prefault,
+            stripes=self.stripes,
+        )
+
+    def _alive(self, conn):
+        return self.conns.get(conn.addr) is conn
+
+    def _accept(self, listener):
+        # Drain the listen backlog on each readiness event, so that a burst of
+        # reconnecting clients does not need one loop iteration each. The
+        # batch is bounded to keep serving existing connections meanwhile.
+        unix = listener.family == socket.AF_UNIX and listener.getsockname()
+        accepted = []
+        for _ in range(1024):
+            try:
+                sock, addr = listener.accept()
+            except BlockingIOError:
+                break
+            if unix:
+                # Peers of Unix sockets are usually unnamed, so we number them
+                # to get unique addresses.
+                addr = (addrlib.UNIX + unix, next(self.unixids))
+            accepted.append(self._attach(sock, addr))
+        if len(accepted) == 1:
+            addr = addrlib.describe(accepted[0].addr)
+            self._log(f'Accepted connection from {addr}')
+        elif accepted:
+            self._log(f'Accepted {len(accepted)} connections')
+        for conn in accepted:
+            # Clients send the handshake right after connecting, so it has
+            # usually arrived already and we can check it without waiting for
+            # another readiness event. Reading is non-blocking either way.
+            if conn.reactor is self.reactors[0]:
+                self._recv(conn)
+        for reactor in {conn.reactor for conn in accepted}:
+            reactor is not self.reactors[0] and reactor.wake()
+
+    def _attach(self, sock, addr):
         sock.setblocking(False)
         conn = Connection(sock, addr)
-        self.sel.register(sock, selectors.EVENT_READ, data=conn)
-        self.conns[addr] = conn
+        conn.recvbuf = self._recvbuf()
+        conn.sendbufs = buffers.SendQueue(self.options.frame_size)
+        conn.tuning = tuning.Tuning(
+            sock,
+            self.options.profile,
+            self.options.sndbuf,
+            self.options.rcvbuf,
+        )
+        conn.zerocopy = zerocopy.ZeroCopy(sock, self.options.zerocopy)
+        conn.reactor = self.reactors[self.numaccepted % len(self.reactors)]
+        self.numaccepted += 1
+        if conn.reactor is self.reactors[0]:
+            conn.reactor.sel.register(sock, selectors.EVENT_READ, data=conn)
+            self.conns[addr] = conn
+        else:
+            conn.reactor.incoming.append(conn)
+        return conn
 
     def _recv(self, conn):
-        if not conn.recvbuf:
-            conn.recvbuf = buffers.RecvBuffer(self.options.max_msg_size)
         try:
-            if len(conn.handshake) < len(self.handshake):
+            if not conn.ready:
                 self._handshake(conn)
                 return
+            elif conn.shm:
+                messages = conn.shm.receive(conn.sock, conn.recvbuf)
+                conn.sendbufs and self._send(conn)
             else:
-                conn.recvbuf.recv(conn.sock)
+                messages = conn.recvbuf.recv(conn.sock)
+                conn.tuning.received()
+            if conn.shmsetup:
+                messages and self._setupshm(conn, messages)
+                return
+            if conn.codecsetup:
+                messages and self._setupcodec(conn, messages)
+                return
+        except BlockingIOError:
+            # Completion notifications of zero-copy sends also make the socket
+            # readable. They are drained by _send().
+            return
         except OSError as e:
             # For example:
             # - ConnectionResetError
             # - TimeoutError: [Errno 110] Connection timed out
             self._disconnect(conn, e)
             return
-        if not conn.recvbuf.done():
-            return
-        if self.recvq.qsize() > self.options.max_recv_queue:
-            raise RuntimeError('Too many incoming messages enqueued')
-        self.recvq.put((conn.addr, conn.recvbuf.result()))
-        conn.recvbuf = None
+        for message in messages:
+            self.recvq.put((conn.addr, message))
+        full = self.recvq.qsize() >= self.options.max_recv_queue
+        if full and not conn.paused:
+            self._pause(conn)
+
+    def _setupshm(self, conn, messages):
+        assert len(messages) == 1, len(messages)
+        names = bytes(messages[0]).decode('utf-8').split(' ')
+        conn.shm = shmpipe.Channel(names=names)
+        conn.shmsetup = False
+        conn.recvbuf = self._recvbuf()
+        conn.sock.send(b'\x01')
+        self._log(f'Using shared memory for {addrlib.describe(conn.addr)}')
+
+    def _setupcodec(self, conn, messages):
+        # Acknowledge the codec if we support it, so that the client knows
+        # whether to compress its requests. The client waits for the reply
+        # before sending the next handshake, so nothing else is buffered yet.
+        assert len(messages) == 1, len(messages)
+        name, _, size = bytes(messages[0]).decode('utf-8').partition(' ')
+        accepted = codecs.available(name)
+        if accepted:
+            conn.codec = (name, int(size) if size.isdigit() else 64 * 1024)
+        conn.codecsetup = False
+        conn.ready = False
+        conn.handshake = b''
+        conn.recvbuf = self._recvbuf()
+        conn.sock.send(b'\x01' if accepted else b'\x00')
 
     def _disconnect(self, conn, e):
-        detail = f'{type(e).__name__}'
-        detail = f'{detail}: {e}' if str(e) else detail
+        if isinstance(e, str):
+            detail = e
+        else:
+            detail = f'{type(e).__name__}'
+            detail = f'{detail}: {e}' if str(e) else detail
         self._log(
-            f'Closed connection to {conn.addr[0]}:{conn.addr[1]} ({detail})'
+            f'Closed connection to {addrlib.describe(conn.addr)} ({detail})'
         )
         conn = self.conns.pop(conn.addr)
-        if conn.sendbufs:
-            count = len(conn.sendbufs)
-            conn.sendbufs.clear()
+        conn.recvbuf and self.stripes.drop(conn.recvbuf)
+        count = self._drop(conn)
+        if count:
             self._log(f'Dropping {count} messages to disconnected client')
-        self.sel.unregister(conn.sock)
+        conn.events and conn.reactor.sel.unregister(conn.sock)
+        conn.reactor.blocked.discard(conn)
+        conn.reactor.paused.discard(conn)
         conn.sock.close()
+        conn.shm and conn.shm.close()
+
+    def _drop(self, conn):
+        count = conn.sendbufs.clear()
+        with self.lock:
+            self.numsent += count
+        return count
 
     def _numsending(self):
-        return sum(len(x.sendbufs) for x in self.conns.values())
+        return self.numqueued - self.numsent
 
     def _handshake(self, conn):
-        assert len(conn.handshake) < len(self.handshake)
-        size = len(self.handshake) - len(conn.handshake)
-        conn.handshake += conn.sock.recv(size)
-        if conn.handshake != self.handshake[: len(conn.handshake)]:
+        options = [self.handshake, self.query, self.shmquery, self.codecquery]
+        options = [x for x in options if x.startswith(conn.handshake)]
+        size = min(len(x) for x in options) - len(conn.handshake)
+        part = conn.sock.recv(size)
+        if not part:
+            raise ConnectionResetError
+        conn.handshake += part
+        if not any(x.startswith(conn.handshake) for x in options):
             m = f"Expected handshake '{self.handshake}' got '{conn.handshake}'"
             self._disconnect(conn, ValueError(m))
+        elif conn.handshake == self.handshake:
+            conn.ready = True
+        elif conn.handshake == self.shmquery:
+            conn.ready = True
+            conn.shmsetup = True
+        elif conn.handshake == self.codecquery:
+            conn.ready = True
+            conn.codecsetup = True
+        elif conn.handshake == self.query:
+            path = self.options.unix_path
+            path = (addrlib.UNIX + path) if path else ''
+            response = path.encode('utf-8')
+            conn.sock.send(len(response).to_bytes(8, 'little') + response)
+            self._disconnect(conn, f'Advertised Unix socket {path!r}')
 
     def _log(self, *args, **kwargs):
         if not self.options.logging:
@@ -0,0 +1,195 @@
+import mmap
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None  # Windows, where shared memory is not tracked.
+
+
+HEADER = 64
+
+
+class Pipe:
+    """
+    Single-producer single-consumer byte pipe in shared memory.
+
+    The pipe carries the same length-prefixed frames as a socket. It provides
+    `writev()` and `recv_into()` with the semantics of a non-blocking socket,
+    so that the existing send and receive buffers work on top of it. The
+    header stores the total number of bytes written and read, and a flag that
+    the writer sets when it ran out of space. Positions are written only after
+    the data they cover has been copied.
+    """
+
+    def __init__(self, capacity=None, name=None):
+        if name:
+            self.shm = attach(name)
+            capacity = self.shm.size - HEADER
+        else:
+            assert capacity and 0 < capacity, capacity
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=HEADER + capacity
+            )
+        self.capacity = capacity
+        self.meta = np.ndarray((3,), np.uint64, self.shm.buf[:24])
+        self.data = np.ndarray((capacity,), np.uint8, self.shm.buf[HEADER:])
+        if not name:
+            self.meta[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def waiting(self):
+        return bool(self.meta[2])
+
+    def writev(self, iovecs):
+        head, tail = int(self.meta[0]), int(self.meta[1])
+        free = self.capacity - (head - tail)
+        if not free:
+            self.meta[2] = 1
+            raise BlockingIOError
+        written = 0
+        for iovec in iovecs:
+            source = np.frombuffer(iovec, np.uint8)[: free - written]
+            self._copy(head + written, source)
+            written += len(source)
+            if written == free:
+                break
+        self.meta[0] = head + written
+        if written < sum(len(x) for x in iovecs):
+            self.meta[2] = 1
+        return written
+
+    def recv_into(self, buffer):
+        head, tail = int(self.meta[0]), int(self.meta[1])
+        if head == tail:
+            raise BlockingIOError
+        target = np.frombuffer(buffer, np.uint8)
+        size = min(head - tail, len(target))
+        start = tail % self.capacity
+        first = min(size, self.capacity - start)
+        target[:first] = self.data[start : start + first]
+        target[first:size] = self.data[: size - first]
+        self.meta[1] = tail + size
+        return size
+
+    def wakeup(self):
+        # Whether the writer waits for space and should be notified.
+        if not self.meta[2]:
+            return False
+        self.meta[2] = 0
+        return True
+
+    def unlink(self):
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self.meta = None
+        self.data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # Views are still referenced and keep the mapping alive.
+
+    def _copy(self, pos, source):
+        start = pos % self.capacity
+        first = min(len(source), self.capacity - start)
+        self.data[start : start + first] = source[:first]
+        self.data[: len(source) - first] = source[first:]
+
+
+class Channel:
+    def __init__(self, capacity=None, names=None):
+        # The creating side writes into the first pipe and reads from the
+        # second one. The attaching side uses them the other way around.
+        if names:
+            inbox, outbox = names
+            self.inbox = Pipe(name=inbox)
+            self.outbox = Pipe(name=outbox)
+        else:
+            self.outbox = Pipe(capacity)
+            self.inbox = Pipe(capacity)
+
+    @property
+    def names(self):
+        return (self.outbox.name, self.inbox.name)
+
+    def receive(self, sock, recvbuf):
+        # Returns the messages that arrived in the inbox. The socket only
+        # carries notifications when the pipe is used.
+        try:
+            if not sock.recv(4096):
+                raise ConnectionResetError
+        except BlockingIOError:
+            pass
+        messages = []
+        try:
+            while True:
+                messages += recvbuf.recv(self.inbox)
+        except BlockingIOError:
+            pass
+        if self.inbox.wakeup():
+            self.ring(sock)
+        return messages
+
+    def ring(self, sock):
+        # Notifies the peer about new messages or free space in the pipe.
+        try:
+            sock.send(b'\x00')
+        except BlockingIOError:
+            pass  # The peer has unread notifications and will wake up.
+        except OSError:
+            pass  # The peer is gone, which the next read will tell us.
+
+    def unlink(self):
+        self.outbox.unlink()
+        self.inbox.unlink()
+
+    def close(self):
+        self.outbox.close()
+        self.inbox.close()
+
+
+def attach(name):
+    # Attaching should not register the memory with the resource tracker,
+    # because the creator registers it and unregisters it when unlinking. The
+    # tracker may be shared with the creator, so registering and unregistering
+    # here as well would unregister the memory twice.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass  # Python 3.12 and older always register the memory.
+    if not _posixshmem:
+        return shared_memory.SharedMemory(name=name)
+    return Segment(name)
+
+
+class Segment:
+    # Maps existing shared memory with the interface of SharedMemory but
+    # without registering it with the resource tracker.
+
+    def __init__(self, name):
+        self.name = name
+        fd = _posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+        try:
+            self.size = os.fstat(fd).st_size
+            self.mmap = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self.mmap)
+
+    def unlink(self):
+        _posixshmem.shm_unlink('/' + self.name)
+
+    def close(self):
+        self.buf.release()
+        self.mmap.close()
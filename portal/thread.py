@@ -17,9 +17,12 @@ class Thread:
 
     3. The thread is marked as daemon, so that when the parent process dies the
     thread is killed, preventing hangs.
+
+    4. Detached threads are not tracked as subthreads of the thread that
+    creates them, for threads that serve the whole process.
     """
 
-    def __init__(self, fn, *args, name=None, start=False):
+    def __init__(self, fn, *args, name=None, start=False, detached=False):
         self.fn = fn
         self.excode = None
         name = name or getattr(fn, '__name__', 'thread')
@@ -29,7 +32,7 @@ class Thread:
         self.thread.children = []
         self.started = False
         self.ready = threading.Barrier(2)
-        contextlib.context.add_worker(self)
+        detached or contextlib.context.add_worker(self)
         start and self.start()
 
     @property
@@ -0,0 +1,73 @@
+import socket
+
+
+PROFILES = ('latency', 'throughput', 'auto')
+
+
+class Tuning:
+    """
+    Applies a coherent set of socket options for a transport profile:
+
+    1. The `latency` profile disables Nagle's algorithm so that small messages
+    are sent immediately and re-arms quick acknowledgements after every read
+    on Linux, so that the peer is not held back by delayed ACKs.
+
+    2. The `throughput` profile keeps Nagle's algorithm and delayed ACKs
+    enabled, so that the kernel sends full segments and fewer ACKs.
+
+    3. The `auto` profile tracks a moving average of the sent message sizes
+    and switches between the two by toggling Nagle's algorithm. It does not
+    re-arm quick acknowledgements to avoid a syscall per read.
+
+    Socket buffer sizes are only set when given explicitly, because doing so
+    disables the kernel's buffer autotuning.
+    """
+
+    def __init__(self, sock, profile, sndbuf=0, rcvbuf=0, threshold=65536):
+        assert profile in PROFILES, (profile, PROFILES)
+        self.sock = sock
+        self.profile = profile
+        self.threshold = threshold
+        self.tcp = sock.family in (socket.AF_INET, socket.AF_INET6)
+        self.quickack = (
+            self.tcp
+            and profile == 'latency'
+            and hasattr(socket, 'TCP_QUICKACK')
+        )
+        self.mean = None
+        self.mode = None
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self._switch('throughput' if profile == 'throughput' else 'latency')
+
+    def sent(self, size):
+        if self.profile != 'auto':
+            return
+        if self.mean is None:
+            self.mean = size
+        else:
+            self.mean = 0.9 * self.mean + 0.1 * size
+        if self.mean < self.threshold:
+            self._switch('latency')
+        else:
+            self._switch('throughput')
+
+    def received(self):
+        if self.quickack:
+            self._setopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    def _switch(self, mode):
+        if mode == self.mode:
+            return
+        self.mode = mode
+        if self.tcp:
+            nodelay = int(mode == 'latency')
+            self._setopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, nodelay)
+
+    def _setopt(self, level, option, value):
+        try:
+            self.sock.setsockopt(level, option, value)
+        except OSError:
+            pass  # The socket was closed concurrently.
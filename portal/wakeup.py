@@ -0,0 +1,63 @@
+import os
+
+
+class Wakeup:
+    """
+    Coalescing signal for waking up a selector loop from other threads.
+
+    Setting the signal while it is already pending is a no-op without any
+    syscall, and clearing it drains all pending notifications at once. The
+    loop must clear the signal before it processes its work queues, so that
+    items enqueued after the check are covered by a new notification. Uses an
+    eventfd on Linux and a non-blocking pipe elsewhere.
+    """
+
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            flags = os.EFD_NONBLOCK | os.EFD_CLOEXEC
+            self.rfd = self.wfd = os.eventfd(0, flags)
+            self.eventfd = True
+        else:
+            self.rfd, self.wfd = os.pipe()
+            os.set_blocking(self.rfd, False)
+            os.set_blocking(self.wfd, False)
+            self.eventfd = False
+        self.pending = False
+        self.numwrites = 0
+        self.numreads = 0
+
+    def fileno(self):
+        return self.rfd
+
+    def set(self):
+        if self.pending:
+            return
+        self.pending = True
+        self.numwrites += 1
+        try:
+            if self.eventfd:
+                os.eventfd_write(self.wfd, 1)
+            else:
+                os.write(self.wfd, b'\x00')
+        except BlockingIOError:
+            pass  # The pipe is full, so the reader is bound to wake up.
+
+    def clear(self):
+        # Drain before resetting the flag. Otherwise, a concurrent set() could
+        # see the reset flag and write a notification that we then drain,
+        # leaving the flag set without a pending notification.
+        self.numreads += 1
+        try:
+            if self.eventfd:
+                os.eventfd_read(self.rfd)
+            else:
+                while len(os.read(self.rfd, 4096)) == 4096:
+                    pass
+        except BlockingIOError:
+            pass
+        self.pending = False
+
+    def close(self):
+        os.close(self.rfd)
+        if self.wfd != self.rfd:
+            os.close(self.wfd)
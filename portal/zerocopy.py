@@ -0,0 +1,102 @@
+import collections
+import errno
+import os
+import socket
+import struct
+import sys
+
+
+SO_ZEROCOPY = getattr(socket, 'SO_ZEROCOPY', 60)
+MSG_ZEROCOPY = getattr(socket, 'MSG_ZEROCOPY', 0x4000000)
+SO_EE_ORIGIN_ZEROCOPY = 5
+SO_EE_CODE_ZEROCOPY_COPIED = 1
+
+# struct sock_extended_err from linux/errqueue.h
+EXTENDED_ERR = struct.Struct('=IBBBxII')
+
+
+class ZeroCopy:
+    """
+    Sends large writes with `MSG_ZEROCOPY` on Linux:
+
+    1. Writes of at least the threshold size are passed to `sendmsg()` with
+    the zero-copy flag, so that the kernel pins the pages of the buffers
+    instead of copying them into the socket buffer. Smaller writes and other
+    platforms use `writev()` as before.
+
+    2. The kernel reports on the error queue of the socket when it released
+    the pages of a range of zero-copy sends. Until then, we keep references
+    to the buffers of each send, so that the underlying arrays stay alive.
+    The error queue is drained by calling `reap()`.
+
+    3. The kernel falls back to copying when the data does not leave the
+    machine, such as over loopback, which is counted in `numcopied`.
+
+    The object provides `writev()` and `fileno()` so that it can be passed to
+    `buffers.sendmany()` in place of the socket.
+    """
+
+    def __init__(self, sock, threshold=0):
+        self.sock = sock
+        self.threshold = threshold
+        self.enabled = False
+        self.inflight = collections.deque()  # [(seqnum, iovecs)]
+        self.seqnum = 0
+        self.numsends = 0
+        self.numcopied = 0
+        tcp = sock.family in (socket.AF_INET, socket.AF_INET6)
+        if threshold and tcp and sys.platform == 'linux':
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_ZEROCOPY, 1)
+                self.enabled = True
+            except OSError:
+                pass  # Not supported by the kernel.
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def writev(self, iovecs):
+        if not self.enabled or sum(len(x) for x in iovecs) < self.threshold:
+            return os.writev(self.sock.fileno(), iovecs)
+        try:
+            size = self.sock.sendmsg(iovecs, (), MSG_ZEROCOPY)
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # The kernel ran out of option memory to track the pinned pages,
+            # so we copy until earlier sends have completed.
+            return os.writev(self.sock.fileno(), iovecs)
+        self.inflight.append((self.seqnum, iovecs))
+        self.seqnum = (self.seqnum + 1) % 2**32
+        self.numsends += 1
+        return size
+
+    def reap(self):
+        # Drains completion notifications and releases the buffers of all
+        # sends that the kernel no longer references.
+        while self.inflight:
+            try:
+                _, ancdata, _, _ = self.sock.recvmsg(
+                    0,
+                    socket.CMSG_SPACE(EXTENDED_ERR.size),
+                    socket.MSG_ERRQUEUE,
+                )
+            except (BlockingIOError, InterruptedError):
+                return
+            for _, _, data in ancdata:
+                fields = EXTENDED_ERR.unpack(data[: EXTENDED_ERR.size])
+                _, origin, _, code, lo, hi = fields
+                if origin != SO_EE_ORIGIN_ZEROCOPY:
+                    continue
+                if code & SO_EE_CODE_ZEROCOPY_COPIED:
+                    self.numcopied += hi - lo + 1
+                self._release(lo, hi)
+
+    def _release(self, lo, hi):
+        # Sequence numbers are 32 bit and wrap around.
+        count = (hi - lo) % 2**32 + 1
+        remaining = collections.deque()
+        for seqnum, iovecs in self.inflight:
+            if (seqnum - lo) % 2**32 >= count:
+                remaining.append((seqnum, iovecs))
+        self.inflight = remaining
@@ -1,6 +1,9 @@
+import asyncio
+import socket
 import threading
 import time
 
+import numpy as np
 import pytest
 import portal
 
@@ -106,6 +109,23 @@ class TestClient:
         server.close()
         client.close()
 
+    @pytest.mark.parametrize('Server', SERVERS)
+    def test_priority(self, Server):
+        port = portal.free_port()
+        server = Server(port)
+        order = []
+        server.bind('fn', lambda x: order.append(len(x)) or len(x))
+        server.start(block=False)
+        client = portal.Client(port, frame_size=65536)
+        large = client.fn(bytes(64 * 1024**2))
+        small = client.fn(b'foo', priority=1)
+        assert small.result() == 3
+        assert large.result() == 64 * 1024**2
+        # The small request overtook the large one queued before it.
+        assert order == [3, 64 * 1024**2]
+        client.close()
+        server.close()
+
     def test_future_timeout(self):
         port = portal.free_port()
         server = portal.Server(port)
@@ -373,3 +393,200 @@ class TestClient:
         server.start(block=False)
         portal.Process(client, portnum, start=True).join()
         server.close()
+
+    def test_async_client(self):
+        port = portal.free_port()
+        server = portal.Server(port, errors=False)
+        server.bind('add', lambda x, y: x + y)
+        server.bind('fail', lambda: 1 / 0)
+        server.start(block=False)
+
+        async def main():
+            async with portal.AsyncClient(port, maxinflight=4) as client:
+                assert await client.add(3, 5) == 8
+                results = await asyncio.gather(
+                    *[client.add(i, i) for i in range(32)]
+                )
+                assert results == [2 * i for i in range(32)]
+                with pytest.raises(RuntimeError):
+                    await client.fail()
+                assert await client.add(1, 2) == 3
+
+        asyncio.run(main())
+        server.close()
+
+    def test_async_client_manual_connect(self):
+        port = portal.free_port()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+
+        async def main():
+            client = portal.AsyncClient(port, autoconn=False)
+            assert not client.connected
+            with pytest.raises(portal.Disconnected):
+                await client.fn(1)
+            await client.connect(timeout=10)
+            assert client.connected
+            assert await client.fn(12) == 12
+            await client.close()
+
+        asyncio.run(main())
+        server.close()
+
+    @pytest.mark.parametrize('supported', (True, False))
+    def test_async_client_codec(self, supported):
+        port = portal.free_port()
+        server = portal.Server(port)
+        if not supported:
+            # Servers without the codec handshake reject it.
+            server.socket.codecquery = b'disabled_' + server.socket.handshake
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+
+        async def main():
+            client = portal.AsyncClient(port, codec='zlib', codec_minsize=1024)
+            data = np.zeros((64, 64), np.uint8)
+            assert (await client.fn(data) == data).all()
+            assert client.protocol.codec == ('zlib' if supported else None)
+            assert client.codecfailed == (not supported)
+            await client.close()
+
+        asyncio.run(main())
+        server.close()
+
+    def test_shared_reactor(self):
+        port = portal.free_port()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        clients = [portal.Client(port, reactors=1) for _ in range(10)]
+        futures = [client.fn(i) for i, client in enumerate(clients)]
+        assert [x.result() for x in futures] == list(range(10))
+        server.close()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        futures = [client.fn(i) for i, client in enumerate(clients)]
+        assert [x.result() for x in futures] == list(range(10))
+        [client.close() for client in clients]
+        server.close()
+
+    def test_connections(self):
+        port = portal.free_port()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        client = portal.Client(port, connections=4, maxinflight=64)
+        client.connect()
+        futures = [client.fn(bytes([i]) * 1000) for i in range(64)]
+        results = [x.result() for x in futures]
+        assert results == [bytes([i]) * 1000 for i in range(64)]
+        assert len(server.socket.conns) == 4
+        assert len({i for x in futures for i in x.shares}) == 4
+        assert client.outstanding == [0, 0, 0, 0]
+        client.close()
+        server.close()
+
+    def test_connections_resend(self):
+        port = portal.free_port()
+        server = portal.Server(port, workers=4)
+        release = threading.Event()
+
+        def fn(x):
+            x == 'wait' and release.wait()
+            return x
+
+        server.bind('fn', fn)
+        server.start(block=False)
+        # Both connections share a single reactor thread, which also has to
+        # establish the connections again.
+        client = portal.Client(port, connections=2, reactors=1)
+        client.connect()
+        for _ in range(20):
+            release.clear()
+            fast = client.fn('fast')
+            waiting = client.fn('wait')
+            assert fast.result() == 'fast'
+            assert list(waiting.shares) == [1]
+            # The request is sent again once its connection is back, while the
+            # other connection may still be reconnecting.
+            for conn in list(server.socket.conns.values()):
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            release.set()
+            assert waiting.result(timeout=10) == 'wait'
+        client.close()
+        server.close()
+
+    @pytest.mark.parametrize('frame_size', (0, 1024))
+    def test_stripes(self, frame_size):
+        port = portal.free_port()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        client = portal.Client(
+            port, connections=3, stripe_size=1000, frame_size=frame_size
+        )
+        data = bytes(range(256)) * 100
+        futures = [client.fn(data), client.fn(b'small'), client.fn(data)]
+        assert [x.result() for x in futures] == [data, b'small', data]
+        assert len(futures[0].shares) == 3
+        assert len(futures[1].shares) == 1
+        assert not server.socket.stripes.entries
+        client.close()
+        server.close()
+
+    @pytest.mark.parametrize('Server', SERVERS)
+    def test_codec(self, Server):
+        port = portal.free_port()
+        server = Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        client = portal.Client(port, codec='zlib', codec_minsize=1024)
+        client.connect()
+        assert client.socket.codec == 'zlib'
+        data = {'a': np.zeros((64, 64), np.uint8), 'b': np.arange(4)}
+        result = client.fn(data).result()
+        assert portal.tree_equals(result, data)
+        client.close()
+        server.close()
+
+    def test_schemas(self):
+        port = portal.free_port()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        client = portal.Client(port)
+        data = {'a': np.arange(4), 'b': [np.ones(2, np.float32), 'text']}
+        for _ in range(3):
+            assert portal.tree_equals(client.fn(data).result(), data)
+        assert len(server.schemas.schemas) == 1
+        # The server forgets the schema and the client sends it again.
+        server.schemas.schemas.clear()
+        assert portal.tree_equals(client.fn(data).result(), data)
+        assert portal.tree_equals(client.fn(data).result(), data)
+        assert len(server.schemas.schemas) == 1
+        client.close()
+        server.close()
+
+    def test_schemas_resend_error(self, monkeypatch):
+        port = portal.free_port()
+        server = portal.Server(port)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        client = portal.Client(port)
+        data = {'a': np.arange(4), 'b': 'text'}
+        assert portal.tree_equals(client.fn(data).result(), data)
+        server.schemas.schemas.clear()
+
+        def fail(*args, **kwargs):
+            raise ValueError('failed to pack')
+
+        # Packing the request again fails inside the reactor thread.
+        with monkeypatch.context() as patch:
+            patch.setattr(portal.packlib, 'pack', fail)
+            with pytest.raises(ValueError):
+                client.fn(data).result()
+        assert portal.tree_equals(client.fn(data).result(), data)
+        client.close()
+        server.close()
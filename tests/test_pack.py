@@ -1,3 +1,7 @@
+import collections
+import zlib
+
+import msgpack
 import pytest
 import portal
 import numpy as np
@@ -33,3 +37,171 @@ class TestPack:
         assert (restored['foo'].array == content).all()
         assert restored['foo'].name == value.name
         value.close()
+
+    @pytest.mark.parametrize('codec', ('zlib', 'lzma'))
+    def test_codec(self, codec):
+        value = {
+            'frames': np.zeros((16, 64, 64), np.uint8),
+            'mask': np.ones(4096, np.int8),
+            'small': np.arange(10),
+            'noise': np.random.randint(0, 256, 4096, np.uint8),
+            'text': bytes(10000),
+        }
+        buffers = portal.pack(value, codec, minsize=1024)
+        flags = [spec[-1] == codec for spec in msgpack.unpackb(buffers[3])]
+        assert flags == [True, True, False, False, True]
+        buffer = b''.join(buffers)
+        assert len(buffer) < 10000
+        restored = portal.unpack(buffer)
+        assert portal.tree_equals(value, restored)
+        restored['frames'][0] = 1
+
+    def test_register_codec(self):
+        portal.codecs.register(
+            'reverse',
+            lambda x: zlib.compress(bytes(x)[::-1]),
+            lambda x: zlib.decompress(x)[::-1],
+        )
+        value = [np.arange(1000, dtype=np.int64), np.random.rand(100)]
+        buffers = portal.pack(value, 'reverse', minsize=0)
+        # Leaves are only compressed when the codec makes them smaller.
+        specs = msgpack.unpackb(buffers[3])
+        assert specs == [['array', [1000], '<i8', 'reverse'], specs[1]]
+        assert len(specs[1]) == 3
+        restored = portal.unpack(b''.join(buffers))
+        assert portal.tree_equals(value, restored)
+
+    @pytest.mark.parametrize('codec', ('zlib', 'lzma'))
+    def test_codec_chunks(self, codec):
+        value = np.tile(np.arange(1000, dtype=np.float32), (50, 1))
+        buffers = portal.pack(value, codec, minsize=1024, chunksize=30000)
+        spec = msgpack.unpackb(buffers[3])[0]
+        assert spec[3:5] == [codec, 30000]
+        assert len(spec[5]) == 7
+        restored = portal.unpack(b''.join(buffers))
+        assert (restored == value).all()
+        restored[0] = 1
+
+    def test_codec_chunks_error(self):
+        error = ValueError('Cannot compress')
+
+        def compress(buffer):
+            raise error
+
+        portal.codecs.register('failing', compress, zlib.decompress)
+        value = np.zeros(100000, np.uint8)
+        with pytest.raises(ValueError) as info:
+            portal.pack(value, 'failing', minsize=0, chunksize=10000)
+        assert info.value is error
+
+    def test_schemas(self):
+        sender = portal.packlib.Schemas()
+        receiver = portal.packlib.SchemaCache()
+        value = {'a': np.arange(3), 'b': [bytes(4), 'text', None]}
+        buffers, schema = sender.pack(value)
+        assert schema
+        full = sum(len(x) for x in buffers)
+        restored = portal.unpack(b''.join(buffers), receiver)
+        assert portal.tree_equals(value, restored)
+        sender.confirm(schema)
+        buffers, schema = sender.pack(value)
+        assert not schema
+        assert sum(len(x) for x in buffers) < full
+        restored = portal.unpack(b''.join(buffers), receiver)
+        assert portal.tree_equals(value, restored)
+        with pytest.raises(portal.packlib.UnknownSchema):
+            portal.unpack(b''.join(buffers), portal.packlib.SchemaCache())
+        # Confirmations of previous sessions are ignored.
+        sender.reset()
+        sender.confirm(schema or (sender.session ^ 1, 0))
+        buffers, schema = sender.pack(value)
+        assert schema
+
+    def test_tree_flatten(self):
+        Point = collections.namedtuple('Point', 'x, y')
+        tree = {
+            'a': [1, (2, 3), {'b': None}],
+            'c': collections.OrderedDict(d=4, e=[]),
+            'f': Point(5, 6),
+            'g': (),
+        }
+        leaves, structure = portal.packlib.tree_flatten(tree)
+        assert leaves == (1, 2, 3, None, 4, 5, 6)
+        assert structure == {
+            'a': [None, (None, None), {'b': None}],
+            'c': {'d': None, 'e': []},
+            'f': (None, None),
+            'g': (),
+        }
+        restored = portal.packlib.tree_unflatten(leaves, structure)
+        assert restored == {
+            'a': [1, (2, 3), {'b': None}],
+            'c': {'d': 4, 'e': []},
+            'f': (5, 6),
+            'g': (),
+        }
+        assert portal.packlib.tree_map(lambda x: x, tree) == restored
+
+    def test_tree_flatten_deep(self):
+        # Deeper than the recursion limit.
+        tree = 42
+        for _ in range(5000):
+            tree = [tree]
+        leaves, structure = portal.packlib.tree_flatten(tree)
+        assert leaves == (42,)
+        restored = portal.packlib.tree_unflatten([12], structure)
+        for _ in range(5000):
+            restored = restored[0]
+        assert restored == 12
+
+    def test_inline(self):
+        value = {
+            'ints': list(range(20)),
+            'text': ['', 'short', 'x' * 1000],
+            'bytes': [b'', b'abc', bytes(1000)],
+            'arrays': [np.arange(4), np.zeros((0, 3)), np.zeros(1000)],
+            'none': None,
+        }
+        buffers = portal.pack(value, inline_size=256)
+        # Header buffers, inlined values, and one buffer per large leaf.
+        assert len(buffers) == 5 + 3
+        restored = portal.unpack(b''.join(buffers))
+        assert portal.tree_equals(value['text'], restored['text'])
+        assert restored['bytes'][:2] == [b'', b'abc']
+        assert restored['arrays'][1].shape == (0, 3)
+        assert all((restored['ints'][i] == i).all() for i in range(20))
+        restored['arrays'][0][0] = 1
+        buffers = portal.pack(value, inline_size=0)
+        # Only empty leaves are inlined.
+        assert len(buffers) == 5 + 20 + 2 + 2 + 2
+
+    @pytest.mark.parametrize('codec', [None, 'zlib'])
+    def test_bytes_type(self, codec):
+        value = [b'', b'x' * 16, b'x' * 17, bytes(100000)]
+        buffers = portal.pack(value, codec, minsize=0, inline_size=16)
+        # Leaves have the type of the message, whether inlined or not.
+        restored = portal.unpack(b''.join(buffers))
+        assert all(type(x) is bytes for x in restored)
+        assert restored == value
+        restored = portal.unpack(memoryview(b''.join(buffers)))
+        assert all(type(x) is memoryview for x in restored)
+        assert [bytes(x) for x in restored] == value
+
+    @pytest.mark.parametrize('codec', [None, 'zlib'])
+    def test_strided(self, codec):
+        array = np.arange(64 * 2048, dtype=np.float32).reshape(64, 2048)
+        value = {
+            'rows': array[::2],
+            'cols': array[:, :1024],
+            'reversed': array[::-1],
+            'fortran': np.asfortranarray(array),
+            'transposed': array.T,
+            'small': array[::2, ::2],
+        }
+        restored = portal.unpack(b''.join(portal.pack(value, codec)))
+        for key, expected in value.items():
+            assert restored[key].flags.c_contiguous
+            assert restored[key].shape == expected.shape
+            assert (restored[key] == expected).all()
+        # Header buffers, inlined values, and one buffer per contiguous row.
+        assert len(portal.pack(array[::2])) == 5 + 32
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import threading
 import time
@@ -384,3 +385,34 @@ class TestServer:
         assert client.fn(42).result() == 42
         client.close()
         server.close()
+
+    @pytest.mark.parametrize('Server', SERVERS)
+    def test_unix_address(self, Server, tmp_path):
+        addr = f'unix://{tmp_path}/server.sock'
+        server = Server(addr)
+        server.bind('fn', lambda x: x)
+        server.start(block=False)
+        client = portal.Client(addr)
+        assert client.fn(42).result() == 42
+        client.close()
+        server.close()
+
+    @pytest.mark.parametrize('Server', SERVERS)
+    def test_async_method(self, Server):
+        port = portal.free_port()
+        server = Server(port)
+
+        async def fn(x):
+            await asyncio.sleep(0.1)
+            return x
+
+        server.bind('fn', fn)
+        server.start(block=False)
+        client = portal.Client(port, maxinflight=64)
+        start = time.time()
+        futures = [client.fn(i) for i in range(64)]
+        assert [x.result() for x in futures] == list(range(64))
+        # Requests sleep concurrently on the same event loop.
+        assert time.time() - start < 3
+        client.close()
+        server.close()
@@ -1,5 +1,12 @@
+import collections
+import select
+import socket
+import subprocess
+import sys
+import threading
 import time
 
+import numpy as np
 import pytest
 import portal
 
@@ -19,6 +26,167 @@ class TestSocket:
         server.close()
         client.close()
 
+    @pytest.mark.parametrize('profile', ('latency', 'throughput', 'auto'))
+    def test_profile(self, profile):
+        port = portal.free_port()
+        server = portal.ServerSocket(port, profile=profile)
+        client = portal.ClientSocket(port, profile=profile)
+        client.send(b'foo')
+        addr, data = server.recv()
+        assert data == b'foo'
+        server.send(addr, b'bar')
+        assert client.recv() == b'bar'
+        nodelay = client.tuning.sock.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY
+        )
+        assert bool(nodelay) == (profile != 'throughput')
+        server.close()
+        client.close()
+
+    def test_unix(self, tmp_path):
+        addr = f'unix://{tmp_path}/server.sock'
+        server = portal.ServerSocket(addr)
+        client = portal.ClientSocket(addr)
+        client.send(b'foo')
+        addr, data = server.recv()
+        assert data == b'foo'
+        server.send(addr, b'bar')
+        assert client.recv() == b'bar'
+        client.close()
+        server.close()
+        assert not (tmp_path / 'server.sock').exists()
+
+    @pytest.mark.parametrize('advertise', (True, False))
+    def test_unix_upgrade(self, tmp_path, advertise):
+        port = portal.free_port()
+        path = str(tmp_path / 'server.sock') if advertise else ''
+        server = portal.ServerSocket(port, unix_path=path)
+        client = portal.ClientSocket(port, unix_upgrade=True)
+        client.send(b'foo')
+        addr, data = server.recv()
+        assert data == b'foo'
+        assert addr[0] == (f'unix://{path}' if advertise else '127.0.0.1')
+        server.send(addr, b'bar')
+        assert client.recv() == b'bar'
+        client.close()
+        server.close()
+
+    @pytest.mark.parametrize('size', (3, 10000, 100000))
+    def test_shm(self, size):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        client = portal.ClientSocket(port, shm_ring=4096)
+        data = np.arange(size, dtype=np.uint8).tobytes()
+        for _ in range(3):
+            client.send(data)
+        for _ in range(3):
+            addr, result = server.recv()
+            assert bytes(result) == data
+        assert client.channel is not None
+        for _ in range(3):
+            server.send(addr, data)
+        for _ in range(3):
+            assert bytes(client.recv()) == data
+        client.close()
+        server.close()
+
+    def test_shm_missed_wakeup(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        client = portal.ClientSocket(port, shm_ring=4096)
+        client.connect()
+        while not server.conns or not list(server.conns.values())[0].shm:
+            time.sleep(0.01)
+        # The server never tells the client about free space in the pipe,
+        # as if every notification was lost.
+        list(server.conns.values())[0].shm.ring = lambda sock: None
+        data = np.arange(3000, dtype=np.uint8).tobytes()
+        for _ in range(5):
+            client.send(data)
+        for _ in range(5):
+            addr, result = server.recv(timeout=10)
+            assert bytes(result) == data
+        client.close()
+        server.close()
+
+    @pytest.mark.parametrize('shm_ring', (0, 4096))
+    @pytest.mark.parametrize('codec', ('zlib', 'unknown'))
+    def test_codec_handshake(self, codec, shm_ring):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        client = portal.ClientSocket(
+            port, codec=codec, codec_minsize=1024, shm_ring=shm_ring
+        )
+        client.send(b'foo')
+        addr, data = server.recv()
+        assert data == b'foo'
+        server.send(addr, b'bar')
+        assert client.recv() == b'bar'
+        if codec == 'zlib':
+            assert client.codec == 'zlib'
+            assert server.codec(addr) == ('zlib', 1024)
+        else:
+            assert client.codec is None
+            assert server.codec(addr) == (None, 0)
+        assert bool(client.channel) == bool(shm_ring)
+        client.close()
+        server.close()
+
+    def test_codec_old_server(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        # Servers without the codec handshake reject it.
+        server.codecquery = b'disabled_' + server.handshake
+        client = portal.ClientSocket(port, codec='zlib')
+        client.send(b'foo')
+        addr, data = server.recv()
+        assert data == b'foo'
+        assert client.codecfailed
+        assert client.codec is None
+        assert server.codec(addr) == (None, 0)
+        client.close()
+        server.close()
+
+    def test_shm_tracker(self):
+        # The resource tracker reports errors or leaks on stderr.
+        code = (
+            'import portal\n'
+            'channel = portal.shmpipe.Channel(4096)\n'
+            'other = portal.shmpipe.Channel(names=channel.names)\n'
+            'channel.unlink()\n'
+            'other.close()\n'
+            'channel.close()\n'
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True
+        )
+        assert result.returncode == 0, result.stderr
+        assert not result.stderr, result.stderr
+
+    def test_backpressure(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port, max_recv_queue=4)
+        client = portal.ClientSocket(port, max_recv_queue=4)
+        data = bytes(100000)
+        for i in range(100):
+            client.send(i.to_bytes(8, 'little'), data)
+        time.sleep(0.5)
+        assert server.stats()['numpaused'] == 1
+        for i in range(100):
+            addr, result = server.recv()
+            assert int.from_bytes(result[:8], 'little') == i
+        assert server.stats()['pausetime'][addr] > 0
+        for i in range(100):
+            server.send(addr, i.to_bytes(8, 'little'), data)
+        time.sleep(0.5)
+        assert client.paused
+        for i in range(100):
+            assert int.from_bytes(client.recv()[:8], 'little') == i
+        assert client.pausetime > 0
+        assert server.error is None
+        client.close()
+        server.close()
+
     def test_multi_buffer(self):
         port = portal.free_port()
         server = portal.ServerSocket(port)
@@ -52,6 +220,322 @@ class TestSocket:
         server.close()
         client.close()
 
+    @pytest.mark.parametrize('reactors', (1, 3))
+    def test_reactors(self, reactors):
+        port = portal.free_port()
+        server = portal.ServerSocket(port, reactors=reactors)
+        clients = [portal.ClientSocket(port) for _ in range(8)]
+        for i, client in enumerate(clients):
+            client.send(i.to_bytes(8, 'little'))
+        for _ in clients:
+            addr, data = server.recv()
+            server.send(addr, data, b'!')
+        for i, client in enumerate(clients):
+            assert client.recv() == i.to_bytes(8, 'little') + b'!'
+        assert len(server.connections) == len(clients)
+        [x.close() for x in clients]
+        time.sleep(0.2)
+        assert len(server.connections) == 0
+        server.close()
+
+    def test_wakeup_coalesces(self):
+        signal = portal.wakeup.Wakeup()
+        assert not select.select([signal], [], [], 0)[0]
+        for _ in range(1000):
+            signal.set()
+        assert signal.numwrites == 1
+        assert select.select([signal], [], [], 0)[0]
+        signal.clear()
+        assert not select.select([signal], [], [], 0)[0]
+        signal.set()
+        assert signal.numwrites == 2
+        assert select.select([signal], [], [], 0)[0]
+        signal.close()
+
+    @pytest.mark.parametrize('chunksize', (16, 64, 1024))
+    def test_recv_ring(self, chunksize):
+        rng = np.random.default_rng(0)
+        sizes = rng.integers(1, 200, 100)
+        messages = [bytes(rng.integers(0, 256, x, np.uint8)) for x in sizes]
+        stream = b''.join(len(x).to_bytes(8, 'little') + x for x in messages)
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        ring = portal.buffers.RecvRing(1024, chunksize)
+        received = []
+        while stream:
+            amount = int(rng.integers(1, 300))
+            theirs.sendall(stream[:amount])
+            stream = stream[amount:]
+            try:
+                while True:
+                    received += ring.recv(ours)
+            except BlockingIOError:
+                pass
+        assert [bytes(x) for x in received] == messages
+        ours.close()
+        theirs.close()
+
+    def test_sendmany(self):
+        ours, theirs = socket.socketpair()
+        ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        ours.setblocking(False)
+        messages = [bytes([i % 256]) * (1 + 37 * i) for i in range(200)]
+        parts = [[p for p in (x[:1], x[1:]) if p] for x in messages]
+        sendbufs = collections.deque(
+            portal.buffers.SendBuffer(*x) for x in parts
+        )
+        ring = portal.buffers.RecvRing(1024**2)
+        received = []
+        while len(received) < len(messages):
+            try:
+                while sendbufs:
+                    portal.buffers.sendmany(ours, sendbufs)
+                    while sendbufs and sendbufs[0].done():
+                        sendbufs.popleft()
+            except BlockingIOError:
+                pass
+            received += ring.recv(theirs)
+        assert [bytes(x) for x in received] == messages
+        ours.close()
+        theirs.close()
+
+    def test_buffer_pool(self):
+        pool = portal.buffers.BufferPool(maxbytes=1024**2)
+        assert pool.sizeclass(1) == 4096
+        assert pool.sizeclass(100000) == 114688
+        buffer = pool.allocate(100000)
+        assert len(buffer) == 100000
+        array = np.frombuffer(buffer[10:], np.uint8)
+        del buffer
+        assert pool.allocate(100000) is not None
+        assert pool.numhits == 0  # Still referenced by the array.
+        del array
+        pool.allocate(100000)
+        assert pool.numhits == 1
+        large = pool.allocate(2 * 1024**2)  # Exceeds the cap.
+        assert len(large) == 2 * 1024**2
+        assert pool.owned <= pool.maxbytes
+
+    def test_buffer_pool_trim(self):
+        pool = portal.buffers.BufferPool(maxbytes=1024**2, maxidle=0.1)
+        pool.allocate(100000)
+        assert pool.cached == pool.owned == 114688
+        time.sleep(0.2)
+        buffer = pool.allocate(10)
+        assert len(buffer) == 10
+        assert pool.cached == 0
+        assert pool.owned == 4096
+
+    def test_shared_pool(self, monkeypatch):
+        monkeypatch.setattr(portal.buffers.BufferPool, 'instance', None)
+        port = portal.free_port()
+        server = portal.ServerSocket(port, pool_size=8 * 1024**2)
+        clients = [
+            portal.ClientSocket(port, pool_size=4 * 1024**2) for _ in range(3)
+        ]
+        assert all(client.pool is server.pool for client in clients)
+        assert server.pool.maxbytes == 8 * 1024**2
+        data = bytes(3 * 1024**2)
+        results = []
+        for client in clients:
+            client.send(data)
+            addr, result = server.recv()
+            server.send(addr, result)
+            results.append(result)
+        results += [client.recv() for client in clients]
+        assert all(bytes(x) == data for x in results)
+        assert server.pool.owned <= 8 * 1024**2
+        [client.close() for client in clients]
+        server.close()
+
+    @pytest.mark.parametrize('prefault', (False, True))
+    def test_hugepages(self, prefault):
+        arr = portal.buffers.empty(5 * 1024**2, 1024**2, prefault)
+        assert arr.shape == (5 * 1024**2,)
+        arr[:] = 1
+        assert arr.sum() == 5 * 1024**2
+        port = portal.free_port()
+        kwargs = dict(hugepages=1024**2, prefault=prefault, pool_size=0)
+        server = portal.ServerSocket(port, **kwargs)
+        client = portal.ClientSocket(port, **kwargs)
+        data = np.arange(8 * 1024**2, dtype=np.uint8).tobytes()
+        client.send(data)
+        _, result = server.recv()
+        assert bytes(result) == data
+        client.close()
+        server.close()
+
+    def test_pool_messages(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        client = portal.ClientSocket(port)
+        data = np.arange(1024**2, dtype=np.uint8).tobytes()
+        for _ in range(5):
+            client.send(data)
+            _, result = server.recv()
+            assert bytes(result) == data
+            del result
+        assert server.pool.numhits >= 3
+        client.close()
+        server.close()
+
+    @pytest.mark.parametrize('chunksize', (64, 65536))
+    def test_send_queue(self, chunksize):
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        large = np.arange(10000, dtype=np.uint8).tobytes()
+        sendq = portal.buffers.SendQueue(framesize=1000)
+        sendq.append(portal.buffers.SendBuffer(large[:10], large[10:]))
+        sendq.append(portal.buffers.SendBuffer(b'small'))
+        sendq.append(portal.buffers.SendBuffer(large[::-1]))
+        sendq.append(portal.buffers.SendBuffer(b'urgent'), priority=1)
+        assert len(sendq) == 4
+        ring = portal.buffers.RecvRing(1024**2, chunksize)
+        received = []
+        while sendq:
+            portal.buffers.sendmany(ours, sendq.schedule())
+            sendq.release()
+            try:
+                while True:
+                    received += ring.recv(theirs)
+            except BlockingIOError:
+                pass
+        received = [bytes(x) for x in received]
+        assert received == [b'urgent', b'small', large, large[::-1]]
+        assert not ring.streams
+        ours.close()
+        theirs.close()
+
+    @pytest.mark.parametrize('framesize', (0, 1000))
+    def test_stripes(self, framesize):
+        pairs = [socket.socketpair() for _ in range(3)]
+        [theirs.setblocking(False) for _, theirs in pairs]
+        stripes = portal.buffers.Stripes()
+        rings = [
+            portal.buffers.RecvRing(1024**2, 64, stripes=stripes)
+            for _ in pairs
+        ]
+        large = np.arange(10000, dtype=np.uint8).tobytes()
+
+        def drain(ring, sock):
+            received = []
+            try:
+                while True:
+                    received += ring.recv(sock)
+            except BlockingIOError:
+                return received
+
+        first = portal.buffers.SendBuffer(large).stripes(3, 1 << 32)
+        second = portal.buffers.SendBuffer(large).stripes(3, 2 << 32)
+        received = []
+        # Stripes arrive over the connections in reverse order.
+        for (ours, theirs), ring, stripe in reversed(
+            list(zip(pairs, rings, first))
+        ):
+            sendq = portal.buffers.SendQueue(framesize)
+            sendq.append(stripe)
+            while sendq:
+                portal.buffers.sendmany(ours, sendq.schedule())
+                sendq.release()
+            received += drain(ring, theirs)
+        assert [bytes(x) for x in received] == [large]
+        assert not stripes.entries
+        # Losing a connection drops the partial messages of its sender.
+        for (ours, theirs), ring, stripe in list(zip(pairs, rings, second))[
+            :2
+        ]:
+            portal.buffers.sendmany(ours, [stripe])
+            assert drain(ring, theirs) == []
+        assert len(stripes.entries) == 1
+        stripes.drop(rings[0])
+        assert not stripes.entries
+        portal.buffers.sendmany(pairs[2][0], [second[2]])
+        assert drain(rings[2], pairs[2][1]) == []
+        assert not stripes.entries
+        # The lost connection did not receive any stripe of the partial
+        # message. The sender switches to a new nonce on the other ones.
+        third = portal.buffers.SendBuffer(large).stripes(3, 3 << 32)
+        fourth = portal.buffers.SendBuffer(large).stripes(3, 4 << 32)
+        for index in (1, 2):
+            portal.buffers.sendmany(pairs[index][0], [third[index]])
+            assert drain(rings[index], pairs[index][1]) == []
+        assert len(stripes.entries) == 1
+        stripes.drop(rings[0])
+        assert len(stripes.entries) == 1
+        portal.buffers.sendmany(pairs[1][0], [fourth[1]])
+        assert drain(rings[1], pairs[1][1]) == []
+        assert list(stripes.entries) == [4 << 32]
+        [(ours.close(), theirs.close()) for ours, theirs in pairs]
+
+    @pytest.mark.skipif(sys.platform != 'linux', reason='Linux only')
+    def test_zerocopy(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port, zerocopy=65536)
+        client = portal.ClientSocket(port, zerocopy=65536)
+        data = np.arange(4 * 1024**2, dtype=np.uint8).tobytes()
+        for _ in range(3):
+            client.send(data)
+        for _ in range(3):
+            addr, result = server.recv()
+            assert bytes(result) == data
+        server.send(addr, data)
+        assert bytes(client.recv()) == data
+        assert client.zerocopy.enabled
+        assert client.zerocopy.numsends > 0
+        deadline = time.time() + 5
+        while client.zerocopy.inflight and time.time() < deadline:
+            time.sleep(0.01)
+        assert not client.zerocopy.inflight
+        client.close()
+        server.close()
+
+    def test_priority(self):
+        listener = socket.create_server(('localhost', 0))
+        port = listener.getsockname()[1]
+        client = portal.ClientSocket(port, frame_size=65536)
+        client.connect()
+        peer, _ = listener.accept()
+        peer.setblocking(False)
+        # The peer does not read yet, so the large message fills the socket
+        # buffers and the following messages stay in the send queue.
+        client.send(bytes(64 * 1024**2))
+        time.sleep(0.5)
+        for i in range(5):
+            client.send(b'low' + bytes([i]))
+        client.send(b'high', priority=1)
+        handshake = b''
+        while len(handshake) < len(b'portal_handshake'):
+            try:
+                handshake += peer.recv(
+                    len(b'portal_handshake') - len(handshake)
+                )
+            except BlockingIOError:
+                time.sleep(0.01)
+        assert handshake == b'portal_handshake'
+        ring = portal.buffers.RecvRing(1024**3)
+        received = []
+        while len(received) < 7:
+            try:
+                received += [bytes(x[:8]) for x in ring.recv(peer)]
+            except BlockingIOError:
+                time.sleep(0.001)
+        lows = [b'low' + bytes([i]) for i in range(5)]
+        assert received[:6] == [b'high', *lows]
+        client.close()
+        peer.close()
+        listener.close()
+
+    def test_frames_overtake(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        client = portal.ClientSocket(port, frame_size=65536)
+        client.send(bytes(256 * 1024**2))
+        client.send(b'small')
+        assert bytes(server.recv()[1]) == b'small'
+        assert len(server.recv()[1]) == 256 * 1024**2
+        client.close()
+        server.close()
+
     @pytest.mark.parametrize('repeat', range(3))
     def test_disconnect_server(self, repeat):
         port = portal.free_port()
@@ -207,3 +691,84 @@ class TestSocket:
         with pytest.raises(portal.Disconnected):
             client.recv()
         server.close()
+
+    def test_shared_reactor(self):
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        clients = [portal.ClientSocket(port, reactors=2) for _ in range(10)]
+        assert len({client.reactor for client in clients}) == 2
+        for i, client in enumerate(clients):
+            client.send(bytes([i]))
+        for _ in clients:
+            addr, data = server.recv()
+            server.send(addr, data)
+        for i, client in enumerate(clients):
+            assert client.recv() == bytes([i])
+        [client.close() for client in clients]
+        assert all(client.finished.is_set() for client in clients)
+        server.close()
+
+    def test_shared_reactor_owner(self, monkeypatch):
+        monkeypatch.setattr(portal.client_socket.Reactor, 'instances', [])
+        port = portal.free_port()
+        server = portal.ServerSocket(port)
+        created = []
+        done = threading.Event()
+
+        def owner():
+            client = portal.ClientSocket(port, reactors=1)
+            client.connect()
+            created.append(client)
+            done.wait()
+
+        thread = portal.Thread(owner, start=True)
+        while not created:
+            time.sleep(0.01)
+        # The thread that created the shared reactor does not own it.
+        assert not thread.thread.children
+        thread.kill()
+        client = portal.ClientSocket(port, reactors=1)
+        assert client.reactor is created[0].reactor
+        client.send(b'foo')
+        addr, data = server.recv()
+        server.send(addr, data)
+        assert client.recv() == b'foo'
+        [x.close() for x in (client, *created)]
+        server.close()
+
+    @pytest.mark.parametrize('reactors', (1, 3))
+    def test_accept_burst(self, reactors):
+        port = portal.free_port()
+        server = portal.ServerSocket(port, reactors=reactors)
+        batches = []
+        accept = server._accept
+
+        def counted(listener):
+            before = server.numaccepted
+            accept(listener)
+            batches.append(server.numaccepted - before)
+
+        server._accept = counted
+        # The server does not accept while it is not reading, so that the
+        # clients queue up in the listen backlog.
+        server.reading = False
+        socks = [
+            socket.create_connection(('localhost', port)) for _ in range(300)
+        ]
+        server.reading = True
+        for i, sock in enumerate(socks):
+            size = (2).to_bytes(8, 'little')
+            sock.sendall(b'portal_handshake' + size + i.to_bytes(2, 'little'))
+        for _ in socks:
+            addr, data = server.recv()
+            server.send(addr, data)
+        for i, sock in enumerate(socks):
+            response = b''
+            while len(response) < 10:
+                response += sock.recv(10 - len(response))
+            assert response[8:] == i.to_bytes(2, 'little')
+        assert len(server.connections) == len(socks)
+        # The whole backlog was accepted on the first readiness event.
+        assert batches[0] == len(socks)
+        [x.close() for x in socks]
+        server.close()